@@ -1,11 +1,11 @@
 from logging.config import fileConfig
 
 from sqlalchemy import engine_from_config, URL, pool
-from hydra import compose
 from alembic import context
+from src.config import get_config
 from src.database.repository import Base
 
-hydra_cfg = compose(config_name='config')
+hydra_cfg = get_config()
 ini_config = context.config
 
 if ini_config.config_file_name is not None:
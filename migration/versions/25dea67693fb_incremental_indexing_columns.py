@@ -0,0 +1,43 @@
+"""incremental indexing columns
+
+Revision ID: 25dea67693fb
+Revises: 3b0314ec2cb9
+Create Date: 2026-10-18 11:47:03.218954
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = '25dea67693fb'
+down_revision: Union[str, None] = '3b0314ec2cb9'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('papyrus_embedding', sa.Column('content_hash', sa.String(length=64), nullable=True))
+    op.add_column('papyrus_embedding', sa.Column('model_version', sa.String(), nullable=True))
+    # Earlier full rebuilds inserted duplicates, keep the most recent row per url
+    op.execute(
+        """
+        DELETE FROM papyrus_embedding
+        WHERE id IN (
+            SELECT id FROM (
+                SELECT id, row_number() OVER (PARTITION BY url ORDER BY created_at DESC, id) AS position
+                FROM papyrus_embedding
+            ) ranked
+            WHERE position > 1
+        )
+        """
+    )
+    op.create_index(op.f('ix_papyrus_embedding_url'), 'papyrus_embedding', ['url'], unique=True)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_papyrus_embedding_url'), table_name='papyrus_embedding')
+    op.drop_column('papyrus_embedding', 'model_version')
+    op.drop_column('papyrus_embedding', 'content_hash')
@@ -0,0 +1,33 @@
+"""add hnsw index on embedding
+
+Revision ID: 3b0314ec2cb9
+Revises: 1b540397bcc5
+Create Date: 2026-10-18 09:12:41.512304
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = '3b0314ec2cb9'
+down_revision: Union[str, None] = '1b540397bcc5'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index(
+        'ix_papyrus_embedding_embedding_hnsw',
+        'papyrus_embedding',
+        ['embedding'],
+        unique=False,
+        postgresql_using='hnsw',
+        postgresql_with={'m': 16, 'ef_construction': 64},
+        postgresql_ops={'embedding': 'vector_cosine_ops'},
+    )
+
+
+def downgrade() -> None:
+    op.drop_index('ix_papyrus_embedding_embedding_hnsw', table_name='papyrus_embedding')
@@ -0,0 +1,58 @@
+"""compact embedding columns
+
+Revision ID: 6f2a9c41d8e3
+Revises: 25dea67693fb
+Create Date: 2026-10-18 15:22:37.604118
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from pgvector.sqlalchemy import BIT, HALFVEC
+
+# revision identifiers, used by Alembic.
+revision: str = '6f2a9c41d8e3'
+down_revision: Union[str, None] = '25dea67693fb'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Stored generated columns rewrite the table once, afterwards Postgres keeps them in sync
+    op.add_column(
+        'papyrus_embedding',
+        sa.Column('embedding_half', HALFVEC(128), sa.Computed('CAST(embedding AS halfvec(128))', persisted=True)),
+    )
+    op.add_column(
+        'papyrus_embedding',
+        sa.Column(
+            'embedding_bit', BIT(128), sa.Computed('CAST(binary_quantize(embedding) AS bit(128))', persisted=True)
+        ),
+    )
+    op.create_index(
+        'ix_papyrus_embedding_embedding_half_hnsw',
+        'papyrus_embedding',
+        ['embedding_half'],
+        unique=False,
+        postgresql_using='hnsw',
+        postgresql_with={'m': 16, 'ef_construction': 64},
+        postgresql_ops={'embedding_half': 'halfvec_cosine_ops'},
+    )
+    op.create_index(
+        'ix_papyrus_embedding_embedding_bit_hnsw',
+        'papyrus_embedding',
+        ['embedding_bit'],
+        unique=False,
+        postgresql_using='hnsw',
+        postgresql_with={'m': 16, 'ef_construction': 64},
+        postgresql_ops={'embedding_bit': 'bit_hamming_ops'},
+    )
+
+
+def downgrade() -> None:
+    op.drop_index('ix_papyrus_embedding_embedding_bit_hnsw', table_name='papyrus_embedding')
+    op.drop_index('ix_papyrus_embedding_embedding_half_hnsw', table_name='papyrus_embedding')
+    op.drop_column('papyrus_embedding', 'embedding_bit')
+    op.drop_column('papyrus_embedding', 'embedding_half')
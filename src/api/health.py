@@ -1,11 +1,11 @@
 import logging
+from datetime import datetime
+from typing import Dict, Optional
 from fastapi import APIRouter
-from src.storage.minio import MinioClient
 from pydantic import BaseModel, Field
 from starlette.requests import Request
-from src.database.postgres import Postgres
 from src.health.health import Health
-from hydra import compose
+from src.health.prober import HealthProber
 import httpx
 
 
@@ -13,45 +13,61 @@ router = APIRouter(prefix='/health', tags=['health'])
 
 log = logging.getLogger(__name__)
 
-cfg = compose(config_name='config')
+
+class ComponentHealthResponse(BaseModel):
+    status: Health = Field(description='Health status of the last check')
+    latency_ms: Optional[float] = Field(description='Duration of the last check in milliseconds', default=None)
+    checked_at: Optional[datetime] = Field(description='Time of the last check', default=None)
 
 
 class HealthResponse(BaseModel):
     storage: Health = Field(description='Storage health status')
     database: Health = Field(description='Database health status')
     inference: Health = Field(description='Inference server health status')
+    components: Dict[str, ComponentHealthResponse] = Field(
+        description='Latency and time of the last check per component', default={}
+    )
 
 
 @router.get('', status_code=200, description='Verify whether the application API is operational')
 async def health(request: Request) -> HealthResponse:
-    inference_health = await __check_litserve()
-
+    """Served from the state of the background health prober, no component is contacted here."""
+    status = request.app.state.health_prober.status()
     return HealthResponse(
-        storage=__check_minio(request.app.state.minio_client).value,
-        database=__check_postgres(request.app.state.database).value,
-        inference=inference_health.value,
+        storage=status['storage'].status,
+        database=status['database'].status,
+        inference=status['inference'].status,
+        components={
+            name: ComponentHealthResponse(
+                status=component.status, latency_ms=component.latency_ms, checked_at=component.checked_at
+            )
+            for name, component in status.items()
+        },
     )
 
 
-def __check_minio(minio: MinioClient):
-    return minio.health()
-
-
-def __check_postgres(postgres: Postgres):
-    return postgres.health()
+def create_health_prober(app_state, interval: float, timeout: float) -> HealthProber:
+    """Probe the storage, database and inference server used by the API."""
+    return HealthProber(
+        {
+            'storage': HealthProber.blocking(app_state.minio_client.health),
+            'database': HealthProber.blocking(app_state.database.health),
+            'inference': lambda: __check_litserve(app_state.inference_client),
+        },
+        interval=interval,
+        timeout=timeout,
+    )
 
 
-async def __check_litserve():
-    """Check the health of the inference server asynchronously."""
-    url = cfg.inference.url + '/health'
+async def __check_litserve(client: httpx.AsyncClient):
+    """Check the health of the inference server over the shared inference client."""
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url)
-            if response.status_code == 200:
-                return Health.OK
-            else:
-                log.error(f'Inference server health check failed with status {response.status_code}')
-                return Health.NOT_OK
+        response = await client.get('/health')
+        if response.status_code == 200:
+            return Health.OK
+        else:
+            log.error(f'Inference server health check failed with status {response.status_code}')
+            return Health.NOT_OK
     except httpx.RequestError as exc:
         log.error(f'Error checking inference server health: {exc}')
         return Health.NOT_OK
@@ -1,13 +1,20 @@
+import asyncio
+import functools
 import logging
-from typing import List
+from typing import Dict, List, Optional
 from uuid import UUID
 from celery.result import AsyncResult
-from fastapi import APIRouter, File, Form, UploadFile
+from fastapi import APIRouter, BackgroundTasks, File, Form, UploadFile
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
+from starlette.concurrency import run_in_threadpool
 from starlette.requests import Request
-from src.tasks.workflow_tasks import papyrus_retrieval
-from src.vision.utils import preprocess_image
+from src.config import get_config
+from src.metrics.prometheus import timed
+from src.tasks.workflow_tasks import celery, papyrus_batch_retrieval, papyrus_retrieval, result_channel
+from src.vision.utils import preprocess_image, store_image, warp_image
 from fastapi import HTTPException
+import httpx
 import json
 
 
@@ -15,6 +22,8 @@ router = APIRouter(prefix='/papyrus', tags=['papyrus'])
 
 log = logging.getLogger(__name__)
 
+cfg = get_config()
+
 
 class ScheduleResponse(BaseModel):
     task_id: UUID = Field(
@@ -27,24 +36,189 @@ class ScheduleResponse(BaseModel):
     )
 
 
+K_FORM = Form(1, ge=1, le=100, description='Number of matches to retrieve at most')
+MIN_SIMILARITY_FORM = Form(None, ge=-1, le=1, description='Drop matches below this cosine similarity')
+
+
 @router.post('/submit/', description='initiates a workflow to retrieve top k matches')
 async def schedule_papyrus_retrieval(
-    request: Request, coordinates: str = Form(...), image: UploadFile = File(...)
+    request: Request,
+    coordinates: str = Form(...),
+    image: UploadFile = File(...),
+    k: int = K_FORM,
+    min_similarity: Optional[float] = MIN_SIMILARITY_FORM,
 ) -> ScheduleResponse:
     minio_client = request.app.state.minio_client
+    coordinate_list = parse_coordinates(coordinates)
+
+    image_content = await image.read()
+    file_path = await run_preprocessing(
+        request.app.state, preprocess_image, image_content, coordinate_list, minio_client
+    )
+    log.info(f'file_path: {file_path}')
+    task = papyrus_retrieval(file_path, k=k, min_similarity=min_similarity)  # Execute the workflow
+    return ScheduleResponse(task_id=task.id, status='Papyrus Retrieval has started!')
+
+
+class BatchScheduleResponse(BaseModel):
+    task_id: UUID = Field(
+        title='Batch Task ID',
+        description='Task id of the whole batch, fetch all results with /papyrus/batch/result/{task_id}',
+        examples=['some-unique-task-id'],
+    )
+    status: str = Field(
+        title='Status', description='Initial status of the task', examples=['Papyrus Retrieval has started!']
+    )
+    image_names: List[str] = Field(
+        title='Image Names',
+        description='Stored query images, in the order of the uploaded images',
+        examples=[['papyrus_2c26b46b68ffc68ff99b453c1d30413413422d706483bfa0f98a5e886266e7ae.jpg']],
+    )
+
+
+@router.post('/submit/batch/', description='initiates a single workflow retrieving the top k matches of many images')
+async def schedule_papyrus_batch_retrieval(
+    request: Request,
+    coordinates: str = Form(...),
+    images: List[UploadFile] = File(...),
+    k: int = K_FORM,
+    min_similarity: Optional[float] = MIN_SIMILARITY_FORM,
+) -> BatchScheduleResponse:
+    """
+    ``coordinates`` is a JSON list with one coordinate set per uploaded image, in the same order.
+    """
+    minio_client = request.app.state.minio_client
+    coordinate_sets = parse_coordinates(coordinates)
+    if len(coordinate_sets) != len(images):
+        raise HTTPException(
+            status_code=422, detail=f'Got {len(images)} images but {len(coordinate_sets)} coordinate sets.'
+        )
+    if len(images) > cfg.api.batch.max_images:
+        raise HTTPException(status_code=413, detail=f'At most {cfg.api.batch.max_images} images per batch.')
+
+    image_contents = [await image.read() for image in images]
+    state = request.app.state
+    push_back_if_saturated(state)
+    # OpenCV releases the GIL, so the images are warped and uploaded in parallel
+    image_names = await asyncio.gather(
+        *(
+            run_preprocessing(state, preprocess_image, image_content, coordinate_list, minio_client, push_back=False)
+            for image_content, coordinate_list in zip(image_contents, coordinate_sets)
+        )
+    )
+    task = papyrus_batch_retrieval(list(image_names), k=k, min_similarity=min_similarity)
+    return BatchScheduleResponse(task_id=task.id, status='Papyrus Retrieval has started!', image_names=image_names)
+
 
+async def run_preprocessing(state, func, *args, push_back: bool = True):
+    """
+    Run blocking image preprocessing and storage in the bounded preprocessing pool.
+
+    At most ``api.preprocess.workers`` calls run at a time and ``api.preprocess.queue_size`` more may
+    wait for a worker. Beyond that the request is rejected with 503, so a burst of large uploads
+    cannot pile up unbounded work while the event loop stays free for other requests.
+
+    :param push_back: Reject the call if the pool is saturated, otherwise wait for a free slot.
+    """
+    if push_back:
+        push_back_if_saturated(state)
+    with timed('api', 'preprocess'):  # including the wait for a free worker
+        async with state.preprocess_slots:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(state.preprocess_pool, functools.partial(func, *args))
+
+
+def push_back_if_saturated(state) -> None:
+    if state.preprocess_slots.locked():
+        log.warning('Preprocessing pool is saturated, rejecting request')
+        raise HTTPException(status_code=503, detail='Server is busy, retry later.', headers={'Retry-After': '1'})
+
+
+def parse_coordinates(coordinates: str):
     try:
         coordinate_list = json.loads(coordinates)  # Parse coordinates from JSON string to List[List[float]]
         if not isinstance(coordinate_list, list):
             raise ValueError('Coordinates must be a list of lists.')
     except json.JSONDecodeError:
         raise ValueError('Invalid JSON format for coordinates.')
+    return coordinate_list
+
+
+class SearchResponse(BaseModel):
+    query_status: str = Field(
+        title='Query Status',
+        description='SUCCESS when answered synchronously, PENDING when the query was queued instead',
+        examples=['SUCCESS'],
+    )
+    query_result: List[str] = Field(
+        title='Query Result',
+        description='Result URLs, empty when the query was queued',
+        examples=[['http://example.com/papyrus']],
+        default=[],
+    )
+    scores: List[float] = Field(
+        title='Scores',
+        description='Cosine similarity of each result URL to the query, in the same order',
+        examples=[[0.97]],
+        default=[],
+    )
+    task_id: Optional[UUID] = Field(
+        title='Task ID',
+        description='Set when the system was overloaded and the query was queued, poll /papyrus/result/{task_id}',
+        examples=[None],
+        default=None,
+    )
+
 
+@router.post('/search/', description='retrieves top k matches within the request, without queueing a workflow')
+async def search_papyrus(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    coordinates: str = Form(...),
+    image: UploadFile = File(...),
+    k: int = K_FORM,
+    min_similarity: Optional[float] = MIN_SIMILARITY_FORM,
+) -> SearchResponse:
+    state = request.app.state
+    coordinate_list = parse_coordinates(coordinates)
     image_content = await image.read()
-    file_path = preprocess_image(image_content, coordinate_list, minio_client)
-    log.info(f'file_path: {file_path}')
-    task = papyrus_retrieval(file_path)  # Execute the workflow
-    return ScheduleResponse(task_id=task.id, status='Papyrus Retrieval has started!')
+
+    if state.search_slots.locked():
+        log.info('Synchronous search is saturated, falling back to the queued workflow')
+        file_path = await run_preprocessing(state, preprocess_image, image_content, coordinate_list, state.minio_client)
+        task = papyrus_retrieval(file_path, k=k, min_similarity=min_similarity)
+        return SearchResponse(query_status='PENDING', task_id=task.id)
+
+    async with state.search_slots:
+        image_data = await run_preprocessing(state, warp_image, image_content, coordinate_list)
+        try:
+            async with asyncio.timeout(cfg.api.search.timeout):
+                with timed('api', 'inference'):
+                    embedding = await __compute_embedding(state.inference_client, image_data)
+                matches = await run_in_threadpool(
+                    state.database.papyrus_embedding_repository.get_matches, embedding, k, min_similarity
+                )
+        except TimeoutError:
+            raise HTTPException(status_code=504, detail='Search did not complete in time.')
+
+    if cfg.api.search.store_query:
+        background_tasks.add_task(store_image, image_data, state.minio_client)
+    return SearchResponse(
+        query_status='SUCCESS',
+        query_result=[match.url for match in matches],
+        scores=[match.similarity for match in matches],
+    )
+
+
+async def __compute_embedding(client: httpx.AsyncClient, image_data: bytes) -> List[float]:
+    files = {'request': ('image.jpg', image_data, 'image/jpeg')}
+    try:
+        response = await client.post('/predict', files=files)
+        response.raise_for_status()
+    except httpx.HTTPError as exc:
+        log.error(f'Inference request failed: {exc}')
+        raise HTTPException(status_code=502, detail='Inference server request failed.')
+    return response.json()['embedding']
 
 
 class RetrieveResponse(BaseModel):
@@ -66,25 +240,156 @@ class RetrieveResponse(BaseModel):
         default=[],  # Set default to an empty list
     )
 
+    scores: List[float] = Field(
+        title='Scores',
+        description='Cosine similarity of each result URL to the query, in the same order',
+        examples=[[0.97]],
+        default=[],
+    )
+
+    stage_timings: Dict[str, float] = Field(
+        title='Stage Timings',
+        description='Duration of each workflow stage in milliseconds, reported by the fused workflow only',
+        examples=[{'download': 4.2, 'embedding': 38.5, 'search': 2.1, 'total': 44.9}],
+        default={},
+    )
+
 
 @router.get(
     '/result/{task_id}',
     description='Retrieve, previously scheduled, top k similar papyrus images for a given user query',
 )
 async def retrieve_papyrus(task_id: UUID) -> RetrieveResponse:
-    task_result = AsyncResult(str(task_id))
+    # Reading the result backend blocks, keep it off the event loop
+    response = await run_in_threadpool(task_response, task_id)
+    if response.query_status == 'FAILURE':
+        raise HTTPException(status_code=500, detail='Task failed to complete.')
+    return response
+
+
+@router.get(
+    '/result/{task_id}/events',
+    description='Server-sent events stream that delivers the retrieval result as soon as the task has finished',
+    response_class=StreamingResponse,
+)
+async def stream_papyrus_result(request: Request, task_id: UUID) -> StreamingResponse:
+    """
+    Emits a ``status`` event with the current state, then a single ``result`` event with the
+    :class:`RetrieveResponse` once the task is ready (``query_status`` is ``FAILURE`` if it failed).
+    Comment lines are sent as keep-alives while waiting.
+    """
+    events = request.app.state.result_events
+    return StreamingResponse(
+        _result_events(events, task_id),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+
+async def _result_events(events, task_id: UUID):
+    pubsub = events.pubsub()
+    # Subscribe before reading the state, so a completion in between is not missed
+    await pubsub.subscribe(result_channel(str(task_id)))
+    try:
+        response = await run_in_threadpool(task_response, task_id)
+        yield _sse('status', response.model_dump_json(include={'request_id', 'query_status'}))
+        deadline = asyncio.get_running_loop().time() + cfg.api.events.timeout
+        while response.query_status in ['PENDING', 'STARTED']:
+            if asyncio.get_running_loop().time() > deadline:
+                yield _sse('timeout', response.model_dump_json(include={'request_id', 'query_status'}))
+                return
+            message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=cfg.api.events.keepalive)
+            if message is None:
+                yield ': keep-alive\n\n'
+                continue
+            response = await run_in_threadpool(task_response, task_id)
+        yield _sse('result', response.model_dump_json())
+    finally:
+        await pubsub.unsubscribe()
+        await pubsub.reset()
 
-    if task_result.status in ['PENDING', 'STARTED']:
+
+def _sse(event: str, data: str) -> str:
+    return f'event: {event}\ndata: {data}\n\n'
+
+
+def task_response(task_id: UUID) -> RetrieveResponse:
+    """Read the state and, once ready, the result of a retrieval task from the result backend."""
+    task_result = AsyncResult(str(task_id), app=celery)
+
+    if task_result.status in ['PENDING', 'STARTED', 'FAILURE']:
         return RetrieveResponse(
             request_id=task_result.task_id,
             query_status=task_result.status,
             query_result=[],  # Empty result as it's not available yet
         )
-    elif task_result.status == 'FAILURE':
-        raise HTTPException(status_code=500, detail='Task failed to complete.')
 
-    else:
-        print(f'task_result.result {task_result.result}')
+    result = task_result.result
+    if isinstance(result, dict):
         return RetrieveResponse(
-            request_id=task_result.task_id, query_status=task_result.status, query_result=task_result.result
+            request_id=task_result.task_id,
+            query_status=task_result.status,
+            query_result=result['urls'],
+            scores=result.get('scores', []),
+            stage_timings=result.get('timings', {}),  # fused workflow only
         )
+    # plain list of urls, stored before the results carried scores
+    return RetrieveResponse(request_id=task_result.task_id, query_status=task_result.status, query_result=result)
+
+
+class BatchItemResult(BaseModel):
+    image_name: str = Field(title='Image Name', description='Stored query image')
+    query_result: List[str] = Field(title='Query Result', description='Result URLs of this image')
+    scores: List[float] = Field(
+        title='Scores',
+        description='Cosine similarity of each result URL to this image, in the same order',
+        default=[],
+    )
+
+
+class BatchRetrieveResponse(BaseModel):
+    request_id: UUID = Field(
+        title='Batch Task ID',
+        description='Batch task ID returned by /papyrus/submit/batch/',
+        examples=['123e4567-e89b-12d3-a456-426614174000'],
+    )
+    query_status: str = Field(
+        title='Query Status',
+        description='Status of the computation',
+        examples=['SUCCESS'],
+    )
+    query_results: List[BatchItemResult] = Field(
+        title='Query Results',
+        description='Results per image, in the order of the uploaded images',
+        default=[],
+    )
+
+
+@router.get(
+    '/batch/result/{task_id}',
+    description='Retrieve, previously scheduled, top k similar papyrus images for every image of a batch',
+)
+async def retrieve_papyrus_batch(task_id: UUID) -> BatchRetrieveResponse:
+    # Reading the result backend blocks, keep it off the event loop
+    response = await run_in_threadpool(batch_task_response, task_id)
+    if response.query_status == 'FAILURE':
+        raise HTTPException(status_code=500, detail='Task failed to complete.')
+    return response
+
+
+def batch_task_response(task_id: UUID) -> BatchRetrieveResponse:
+    """Read the state and, once ready, the results of a batch retrieval task from the result backend."""
+    task_result = AsyncResult(str(task_id), app=celery)
+
+    if task_result.status in ['PENDING', 'STARTED', 'FAILURE']:
+        return BatchRetrieveResponse(request_id=task_result.task_id, query_status=task_result.status)
+
+    return BatchRetrieveResponse(
+        request_id=task_result.task_id,
+        query_status=task_result.status,
+        query_results=[
+            # results stored before the batch results carried scores have none
+            BatchItemResult(image_name=item['image'], query_result=item['urls'], scores=item.get('scores', []))
+            for item in task_result.result
+        ],
+    )
@@ -0,0 +1,361 @@
+"""
+End-to-end throughput and latency of the retrieval endpoints.
+
+Drives the real ``src.main:api`` over ASGI with Celery running eagerly in-process. The external services are
+replaced by local stand-ins: MinIO by the in-memory object store, Postgres by a synthetic embedding table
+(``--database postgres`` uses the configured Postgres/pgvector database instead) and the inference server by
+the real :class:`SiameseLitAPI` behind a local ``/predict`` endpoint (``--inference fake`` derives embeddings
+from the image instead of running the model). Query images are synthetic papyrus photos.
+
+For every scenario the requests per second and p50/p95/p99 latency of each endpoint are reported, together
+with the per-stage latencies recorded in ``papyrus_stage_seconds`` (estimated from the histogram buckets).
+``--output`` saves the results as JSON, ``--compare`` prints the change against an earlier JSON result.
+
+Example::
+
+    python -m src.benchmarks.end_to_end --inference fake --table-size 100000 --requests 200 --concurrency 8 \\
+        --output results.json
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import platform
+import subprocess
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Tuple
+
+import httpx
+import numpy as np
+from fastapi import FastAPI, UploadFile
+from starlette.concurrency import run_in_threadpool
+
+from src.benchmarks.stand_ins import (
+    InMemoryDatabase,
+    InMemoryMinio,
+    fake_embedding,
+    synthetic_embedding_table,
+    synthetic_papyrus_image,
+)
+from src.main import api, cfg
+from src.metrics.prometheus import STAGE_SECONDS
+from src.tasks import workflow_tasks
+
+SCENARIOS = ('search', 'submit', 'batch')
+QUANTILES = (50, 95, 99)
+
+
+def create_inference(name: str) -> Callable[[bytes], Dict[str, List[float]]]:
+    """``/predict`` as a function of the encoded image."""
+    if name == 'fake':
+        return fake_embedding
+
+    from src.inference.server import SiameseLitAPI
+
+    lit_api = SiameseLitAPI()
+    lit_api.setup('cpu')
+    lock = threading.Lock()  # a single LitServe worker runs one forward pass at a time
+
+    def predict(image_data: bytes) -> Dict[str, List[float]]:
+        with lock:
+            image = lit_api.decode_request(SimpleNamespace(file=BytesIO(image_data)))
+            return lit_api.encode_response(lit_api.predict(image))
+
+    return predict
+
+
+def inference_app(inference: Callable[[bytes], Dict[str, List[float]]]) -> FastAPI:
+    """Local stand-in for the LitServe HTTP server, so the API exercises its real inference client."""
+    app = FastAPI()
+
+    @app.post('/predict')
+    async def predict(request: UploadFile):
+        return await run_in_threadpool(inference, await request.read())
+
+    return app
+
+
+def create_database(args):
+    if args.database == 'memory':
+        return InMemoryDatabase(args.table_size, latency_ms=args.search_ms)
+
+    from src.database.postgres import Postgres
+    from src.database.repository import PapyrusEmbeddingEntity
+
+    database = Postgres.from_config(cfg)
+    if args.seed_postgres:
+        vectors, urls = synthetic_embedding_table(args.table_size)
+        repository = database.papyrus_embedding_repository
+        for start in range(0, len(urls), 10000):
+            repository.copy_upsert(
+                [
+                    PapyrusEmbeddingEntity(id=uuid.uuid4(), url=url, embedding=vector.tolist())
+                    for url, vector in zip(urls[start : start + 10000], vectors[start : start + 10000])
+                ]
+            )
+    return database
+
+
+def configure(args) -> None:
+    """Point the application at the stand-ins and run Celery in-process."""
+    celery = workflow_tasks.celery
+    celery.conf.task_always_eager = True
+    celery.conf.task_eager_propagates = True
+    celery.conf.task_store_eager_result = True  # results are fetched through /papyrus/result like in production
+    celery.conf.result_backend = 'cache+memory://'
+    workflow_tasks.cfg.cache.enabled = args.cache
+    workflow_tasks.cfg.worker.workflow = args.workflow
+    workflow_tasks._publisher = SimpleNamespace(publish=lambda channel, message: 0)
+
+    inference = create_inference(args.inference)
+    minio = InMemoryMinio(cfg.storage.buckets)
+    database = create_database(args)
+    workflow_tasks._minio_client = minio
+    workflow_tasks._database = database
+    workflow_tasks.send_image_to_litserve = inference
+
+    api.state.minio_client = minio
+    api.state.database = database
+    api.state.inference_client = httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=inference_app(inference)), base_url='http://inference'
+    )
+    api.state.preprocess_pool = ThreadPoolExecutor(max_workers=cfg.api.preprocess.workers)
+
+
+def query_images(args) -> List[Tuple[bytes, str]]:
+    """Synthetic photos with the papyrus marked by a quadrilateral slightly inside the image."""
+    margin = min(args.width, args.height) // 10
+    right, bottom = args.width - margin, args.height - margin
+    coordinates = json.dumps([[margin, margin], [right, margin - 20], [right, bottom], [margin + 20, bottom]])
+    return [(synthetic_papyrus_image(args.width, args.height, seed), coordinates) for seed in range(args.images)]
+
+
+async def run_search(client: httpx.AsyncClient, image, record, args) -> bool:
+    image_data, coordinates = image
+    response = await record(
+        'POST /papyrus/search/',
+        client.post('/papyrus/search/', data={'coordinates': coordinates}, files={'image': ('q.jpg', image_data)}),
+    )
+    return response.is_success
+
+
+async def run_submit(client: httpx.AsyncClient, image, record, args) -> bool:
+    image_data, coordinates = image
+    response = await record(
+        'POST /papyrus/submit/',
+        client.post('/papyrus/submit/', data={'coordinates': coordinates}, files={'image': ('q.jpg', image_data)}),
+    )
+    if not response.is_success:
+        return False
+    response = await record(
+        'GET /papyrus/result/{task_id}', client.get(f'/papyrus/result/{response.json()["task_id"]}')
+    )
+    return response.is_success and response.json()['query_status'] == 'SUCCESS'
+
+
+async def run_batch(client: httpx.AsyncClient, image, record, args) -> bool:
+    images = [image] * args.batch_size
+    response = await record(
+        'POST /papyrus/submit/batch/',
+        client.post(
+            '/papyrus/submit/batch/',
+            data={'coordinates': json.dumps([json.loads(coordinates) for _, coordinates in images])},
+            files=[('images', (f'q{i}.jpg', image_data)) for i, (image_data, _) in enumerate(images)],
+        ),
+    )
+    if not response.is_success:
+        return False
+    task_id = response.json()['task_id']
+    response = await record('GET /papyrus/batch/result/{task_id}', client.get(f'/papyrus/batch/result/{task_id}'))
+    return response.is_success and response.json()['query_status'] == 'SUCCESS'
+
+
+async def run_scenario(name: str, images, args) -> Dict:
+    run_request = {'search': run_search, 'submit': run_submit, 'batch': run_batch}[name]
+    latencies: Dict[str, List[float]] = {}
+
+    async def record(endpoint, request):
+        start = time.perf_counter()
+        response = await request
+        latencies.setdefault(endpoint, []).append((time.perf_counter() - start) * 1000)
+        return response
+
+    api.state.search_slots = asyncio.Semaphore(cfg.api.search.max_concurrency)
+    api.state.preprocess_slots = asyncio.Semaphore(cfg.api.preprocess.workers + cfg.api.preprocess.queue_size)
+    transport = httpx.ASGITransport(app=api)
+    async with httpx.AsyncClient(transport=transport, base_url='http://benchmark', timeout=None) as client:
+        for image in images[: args.warm_up]:
+            await run_request(client, image, lambda endpoint, request: request, args)
+
+        pending = iter(range(args.requests))
+        errors = 0
+
+        async def worker():
+            nonlocal errors
+            for i in pending:
+                start = time.perf_counter()
+                succeeded = await run_request(client, images[i % len(images)], record, args)
+                latencies.setdefault('total', []).append((time.perf_counter() - start) * 1000)
+                errors += not succeeded
+
+        stages_before = stage_histograms()
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - start
+        stages = diff_histograms(stage_histograms(), stages_before)
+
+    return {
+        'requests': args.requests,
+        'errors': errors,
+        'seconds': elapsed,
+        'qps': args.requests / elapsed,
+        'endpoints': {endpoint: summarize(values) for endpoint, values in latencies.items()},
+        'stages': {stage: summarize_histogram(histogram) for stage, histogram in stages.items() if histogram['count']},
+    }
+
+
+def summarize(latencies_ms: List[float]) -> Dict[str, float]:
+    summary = {'count': len(latencies_ms), 'mean_ms': float(np.mean(latencies_ms))}
+    summary.update({f'p{q}_ms': float(np.percentile(latencies_ms, q)) for q in QUANTILES})
+    return summary
+
+
+def stage_histograms() -> Dict[str, Dict]:
+    """Cumulative bucket counts of :data:`STAGE_SECONDS` per ``component/stage``."""
+    histograms: Dict[str, Dict] = {}
+    for metric in STAGE_SECONDS.collect():
+        for sample in metric.samples:
+            stage = f'{sample.labels["component"]}/{sample.labels["stage"]}'
+            histogram = histograms.setdefault(stage, {'buckets': {}, 'count': 0.0, 'sum': 0.0})
+            if sample.name.endswith('_bucket'):
+                histogram['buckets'][float(sample.labels['le'])] = sample.value
+            elif sample.name.endswith('_count'):
+                histogram['count'] = sample.value
+            elif sample.name.endswith('_sum'):
+                histogram['sum'] = sample.value
+    return histograms
+
+
+def diff_histograms(after: Dict[str, Dict], before: Dict[str, Dict]) -> Dict[str, Dict]:
+    empty = {'buckets': {}, 'count': 0.0, 'sum': 0.0}
+    return {
+        stage: {
+            'buckets': {
+                le: value - before.get(stage, empty)['buckets'].get(le, 0.0) for le, value in h['buckets'].items()
+            },
+            'count': h['count'] - before.get(stage, empty)['count'],
+            'sum': h['sum'] - before.get(stage, empty)['sum'],
+        }
+        for stage, h in after.items()
+    }
+
+
+def summarize_histogram(histogram: Dict) -> Dict[str, float]:
+    summary = {'count': int(histogram['count']), 'mean_ms': histogram['sum'] / histogram['count'] * 1000}
+    summary.update({f'p{q}_ms': histogram_quantile(q / 100, histogram) * 1000 for q in QUANTILES})
+    return summary
+
+
+def histogram_quantile(quantile: float, histogram: Dict) -> float:
+    """Linear interpolation within the bucket containing the quantile, like PromQL's histogram_quantile."""
+    bounds = sorted(histogram['buckets'].items())
+    rank = quantile * histogram['count']
+    lower, below = 0.0, 0.0
+    for upper, cumulative in bounds:
+        if cumulative >= rank:
+            if upper == float('inf'):
+                return lower  # beyond the largest finite bucket
+            return lower + (upper - lower) * (rank - below) / max(cumulative - below, 1e-12)
+        lower, below = upper, cumulative
+    return lower
+
+
+def print_results(results: Dict) -> None:
+    for name, scenario in results['scenarios'].items():
+        print(f'\n{name}: {scenario["qps"]:.1f} requests/s, {scenario["errors"]} errors')
+        print(f'  {"endpoint / stage":<40} {"count":>6} ' + ' '.join(f'{f"p{q} ms":>9}' for q in QUANTILES))
+        for label, summary in list(scenario['endpoints'].items()) + list(scenario['stages'].items()):
+            quantiles = ' '.join(f'{summary[f"p{q}_ms"]:>9.2f}' for q in QUANTILES)
+            print(f'  {label:<40} {summary["count"]:>6} {quantiles}')
+
+
+def print_comparison(results: Dict, baseline: Dict) -> None:
+    """Change of the throughput and p99 latencies relative to an earlier run."""
+    print(f'\nCompared to the run of {baseline["run"]["timestamp"]} ({baseline["run"].get("commit")}):')
+    for name, scenario in results['scenarios'].items():
+        previous = baseline['scenarios'].get(name)
+        if previous is None:
+            continue
+        print(
+            f'{name}: {previous["qps"]:.1f} -> {scenario["qps"]:.1f} requests/s ({change(previous["qps"], scenario["qps"])})'
+        )
+        for kind in ('endpoints', 'stages'):
+            for label, summary in scenario[kind].items():
+                if label in previous[kind]:
+                    old, new = previous[kind][label]['p99_ms'], summary['p99_ms']
+                    print(f'  {label:<40} p99 {old:>9.2f} -> {new:>9.2f} ms ({change(old, new)})')
+
+
+def change(old: float, new: float) -> str:
+    return f'{(new - old) / old * 100:+.1f}%' if old else 'n/a'
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ''
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--requests', type=int, default=100, help='measured requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=4, help='requests in flight')
+    parser.add_argument('--warm-up', type=int, default=2, help='unmeasured requests before each scenario')
+    parser.add_argument('--batch-size', type=int, default=4, help='images per batch submission')
+    parser.add_argument('--images', type=int, default=8, help='distinct synthetic query images')
+    parser.add_argument('--width', type=int, default=1600)
+    parser.add_argument('--height', type=int, default=1200)
+    parser.add_argument('--inference', choices=('real', 'fake'), default='real')
+    parser.add_argument('--database', choices=('memory', 'postgres'), default='memory')
+    parser.add_argument('--table-size', type=int, default=10000, help='rows of the synthetic embedding table')
+    parser.add_argument('--seed-postgres', action='store_true', help='upsert the synthetic table into Postgres')
+    parser.add_argument('--search-ms', type=float, default=0.0, help='simulated latency of the in-memory database')
+    parser.add_argument('--workflow', choices=('chain', 'fused'), default=cfg.worker.workflow)
+    parser.add_argument('--cache', action='store_true', help='enable the Redis result cache, needs Redis')
+    parser.add_argument('--output', help='write the results as JSON')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare with')
+    args = parser.parse_args()
+
+    configure(args)
+    images = query_images(args)
+    results = {
+        'run': {
+            'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'arguments': vars(args),
+        },
+        'scenarios': {name: asyncio.run(run_scenario(name, images, args)) for name in args.scenarios},
+    }
+    api.state.preprocess_pool.shutdown()
+
+    print_results(results)
+    if args.compare:
+        with open(args.compare) as file:
+            print_comparison(results, json.load(file))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
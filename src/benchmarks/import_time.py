@@ -0,0 +1,87 @@
+"""
+Import time of the application entry points, measured with ``python -X importtime`` in fresh processes.
+
+Every entry point is imported ``--repeat`` times and the median cumulative import time is reported with
+its heaviest direct and indirect imports. Heavy dependencies that an entry point must not pull in at
+import time are listed in :data:`ENTRY_POINTS`; the benchmark exits with status 1 if one of them is
+imported anyway, so a module level import that undoes the lazy loading is caught.
+
+Example::
+
+    python -m src.benchmarks.import_time --repeat 5
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+# Entry point -> packages it must not import at import time
+ENTRY_POINTS: Dict[str, Tuple[str, ...]] = {
+    'src.config': ('hydra', 'torch', 'cv2', 'minio', 'celery'),
+    'src.database.repository': ('hydra', 'torch', 'cv2', 'minio', 'celery'),
+    'src.database.snapshot': ('torch', 'cv2', 'minio', 'celery'),
+    'src.tasks.scheduled_tasks': ('torch', 'cv2', 'minio', 'celery'),
+    'src.tasks.workflow_tasks': ('torch', 'cv2', 'minio'),
+    'src.main': ('torch', 'cv2', 'minio'),
+    'src.inference.server': ('cv2', 'minio', 'celery'),
+}
+
+
+def import_times(module: str) -> Dict[str, Tuple[int, int]]:
+    """
+    Import a module in a new interpreter.
+
+    :return: Self and cumulative import time in microseconds of every imported module.
+    """
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True,
+        text=True,
+        env=os.environ,
+    )
+    if process.returncode != 0:
+        raise RuntimeError(f'Importing {module} failed:\n{process.stderr[-2000:]}')
+    times = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:') :].split('|')
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+
+def forbidden_imports(times: Dict[str, Tuple[int, int]], forbidden: Tuple[str, ...]) -> List[str]:
+    return sorted({name.split('.')[0] for name in times} & set(forbidden))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modules', nargs='+', default=list(ENTRY_POINTS), help='entry points to import')
+    parser.add_argument('--repeat', type=int, default=3, help='fresh interpreters per entry point')
+    parser.add_argument('--top', type=int, default=5, help='heaviest imports listed per entry point')
+    args = parser.parse_args()
+
+    violations = {}
+    print(f'{"entry point":<28} {"median ms":>10}  heaviest imports (cumulative ms)')
+    for module in args.modules:
+        runs = [import_times(module) for _ in range(args.repeat)]
+        median_ms = statistics.median(run[module][1] for run in runs) / 1000
+        last = runs[-1]
+        # Top level packages only, their cumulative times do not overlap
+        packages = {name: cumulative for name, (_, cumulative) in last.items() if '.' not in name and name != module}
+        heaviest = sorted(packages.items(), key=lambda item: -item[1])[: args.top]
+        print(f'{module:<28} {median_ms:>10.1f}  ' + ', '.join(f'{name} {us / 1000:.0f}' for name, us in heaviest))
+        forbidden = forbidden_imports(last, ENTRY_POINTS.get(module, ()))
+        if forbidden:
+            violations[module] = forbidden
+
+    for module, forbidden in violations.items():
+        print(f'{module} imports {", ".join(forbidden)} at import time', file=sys.stderr)
+    sys.exit(1 if violations else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""
+Latency and throughput of the inference backends on CPU.
+
+The optimized backends need the artifacts of ``python -m src.inference.export``, backends whose artifacts
+are missing are skipped.
+
+Example::
+
+    python -m src.benchmarks.inference_backends --batch-sizes 1 8 32 --runs 20 --threads 4
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from src.inference.engine import BACKENDS, load_backend
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backends', nargs='+', default=list(BACKENDS), choices=BACKENDS)
+    parser.add_argument('--artifact-dir', default='models')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=0, help='intra-op threads, 0 keeps the runtime default')
+    args = parser.parse_args()
+
+    print(f'{"backend":>12} {"batch":>6} {"p50 ms":>8} {"p95 ms":>8} {"images/s":>10}')
+    for name in args.backends:
+        try:
+            backend = load_backend(name, 'cpu', args.artifact_dir, args.threads)
+        except FileNotFoundError as e:
+            print(f'{name:>12} skipped: {e}')
+            continue
+        for batch_size in args.batch_sizes:
+            images = torch.randn(batch_size, 3, 224, 224)
+            for _ in range(args.warmup):
+                backend(images)
+            latencies = []
+            for _ in range(args.runs):
+                start = time.perf_counter()
+                backend(images)
+                latencies.append(time.perf_counter() - start)
+            latencies = np.array(latencies) * 1000
+            throughput = batch_size * args.runs / (latencies.sum() / 1000)
+            print(
+                f'{name:>12} {batch_size:>6} {np.percentile(latencies, 50):>8.2f} '
+                f'{np.percentile(latencies, 95):>8.2f} {throughput:>10.1f}'
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""
+Recall-vs-latency benchmark of the approximate (HNSW/IVFFlat) k-NN query against exact search.
+
+Query vectors are sampled from ``papyrus_embedding`` and perturbed with gaussian noise, so that the
+benchmark resembles real queries (a photo of a known papyrus) rather than uniformly random vectors.
+``--precision`` compares the float32, halfvec and binary quantized index scans, whose column and index
+sizes are reported first.
+
+Example::
+
+    python -m src.benchmarks.knn_recall --queries 200 --k 10 --ef-search 10 20 40 80 160
+    python -m src.benchmarks.knn_recall --k 10 --ef-search 40 160 --precision full half binary
+"""
+
+import argparse
+import logging
+import time
+from typing import List, Tuple
+
+import numpy as np
+from sqlalchemy import func, text
+
+from src.config import get_config
+from src.database.postgres import Postgres
+from src.database.repository import PapyrusEmbeddingEntity
+from src.database.search import PgvectorSearchBackend
+
+log = logging.getLogger(__name__)
+
+
+def sample_queries(database: Postgres, n: int, noise: float, seed: int) -> np.ndarray:
+    with database.session_f() as session:
+        rows = session.query(PapyrusEmbeddingEntity.embedding).order_by(func.random()).limit(n).all()
+    vectors = np.array([row[0] for row in rows], dtype=np.float32)
+    vectors += np.random.default_rng(seed).normal(scale=noise, size=vectors.shape).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def run_queries(database: Postgres, queries: np.ndarray, k: int, exact: bool):
+    repository = database.papyrus_embedding_repository
+    results, latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        results.append(repository.get_k_nearest_embeddings(query.tolist(), k=k, exact=exact))
+        latencies.append(time.perf_counter() - start)
+    return results, np.array(latencies) * 1000
+
+
+def storage_footprint(database: Postgres) -> List[Tuple[str, float, int]]:
+    """:return: Per embedding column, its average size in bytes per row and the size of its HNSW index."""
+    table = PapyrusEmbeddingEntity.__tablename__
+    footprint = []
+    with database.session_f() as session:
+        for column in ('embedding', 'embedding_half', 'embedding_bit'):
+            row_bytes = session.execute(text(f'SELECT avg(pg_column_size({column})) FROM {table}')).scalar()
+            index_bytes = session.execute(
+                text('SELECT pg_relation_size(CAST(:index AS regclass))'), {'index': f'ix_{table}_{column}_hnsw'}
+            ).scalar()
+            footprint.append((column, float(row_bytes or 0), index_bytes))
+    return footprint
+
+
+def recall(expected, actual) -> float:
+    hits = sum(len(set(e) & set(a)) for e, a in zip(expected, actual))
+    total = sum(len(e) for e in expected)
+    return hits / total if total else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--queries', type=int, default=100, help='number of sampled query vectors')
+    parser.add_argument('--k', type=int, default=10, help='number of neighbours per query')
+    parser.add_argument('--noise', type=float, default=0.05, help='std of the noise added to sampled vectors')
+    parser.add_argument('--ef-search', type=int, nargs='+', default=[10, 20, 40, 80, 160, 320])
+    parser.add_argument('--probes', type=int, nargs='+', default=None, help='sweep probes instead (IVFFlat)')
+    parser.add_argument(
+        '--precision', nargs='+', choices=PgvectorSearchBackend.precisions, default=None, help='index scan precisions'
+    )
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    # The index parameters below are pgvector's, whatever search backend the application is configured with
+    cfg = get_config('database.search.backend=pgvector')
+    database = Postgres.from_config(cfg)
+    search_backend = database.papyrus_embedding_repository.search_backend
+    queries = sample_queries(database, args.queries, args.noise, args.seed)
+
+    if args.precision:
+        print(f'{"column":>16} {"bytes/row":>10} {"index MiB":>10}')
+        for column, row_bytes, index_bytes in storage_footprint(database):
+            print(f'{column:>16} {row_bytes:>10.1f} {index_bytes / 2**20:>10.2f}')
+        print()
+
+    exact, exact_latency = run_queries(database, queries, args.k, exact=True)
+    print(f'{"setting":>24} {"recall@" + str(args.k):>10} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8}')
+    print(f'{"exact":>24} {1.0:>10.4f} {_percentiles(exact_latency)}')
+
+    parameter = 'probes' if args.probes else 'ef_search'
+    for precision in args.precision or [search_backend.precision]:
+        search_backend.precision = precision
+        for value in args.probes or args.ef_search:
+            setattr(search_backend, parameter, value)
+            approximate, latency = run_queries(database, queries, args.k, exact=False)
+            setting = f'{precision} {parameter}={value}'
+            print(f'{setting:>24} {recall(exact, approximate):>10.4f} {_percentiles(latency)}')
+
+
+def _percentiles(latency: np.ndarray) -> str:
+    return ' '.join(f'{np.percentile(latency, q):>8.2f}' for q in (50, 95, 99))
+
+
+if __name__ == '__main__':
+    main()
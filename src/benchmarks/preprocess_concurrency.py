@@ -0,0 +1,112 @@
+"""
+Latency of a light endpoint while large query images are uploaded concurrently.
+
+The real application is served by uvicorn in a background thread, with MinIO replaced by the in-memory
+stand-in and the Celery workflow by a no-op. Upload threads post large photos to ``/papyrus/submit/``
+while ``GET /docs`` is requested in a loop and its latency recorded. The ``event-loop`` mode preprocesses
+on the event loop as before, ``pool`` uses the bounded preprocessing pool.
+
+Example::
+
+    python -m src.benchmarks.preprocess_concurrency --uploads 4 --duration 10 --width 4032 --height 3024
+"""
+
+import argparse
+import asyncio
+import json
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from typing import Tuple
+
+import httpx
+import numpy as np
+import uvicorn
+
+from src.api import papyrus_retrieval
+from src.benchmarks.stand_ins import InMemoryMinio, synthetic_papyrus_image
+from src.main import api
+
+
+async def run_inline(state, func, *args, push_back=True):
+    return func(*args)
+
+
+def start_server() -> Tuple[uvicorn.Server, str]:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(api, port=port, lifespan='off', log_level='warning'))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return server, f'http://127.0.0.1:{port}'
+
+
+def upload_loop(base_url, image: bytes, coordinates: str, deadline: float, counts):
+    with httpx.Client(base_url=base_url, timeout=None) as client:
+        while time.perf_counter() < deadline:
+            response = client.post(
+                '/papyrus/submit/',
+                data={'coordinates': coordinates},
+                files={'image': ('query.jpg', image, 'image/jpeg')},
+            )
+            counts[response.status_code] = counts.get(response.status_code, 0) + 1
+
+
+def light_loop(base_url, deadline: float):
+    latencies = []
+    with httpx.Client(base_url=base_url, timeout=None) as client:
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            client.get('/docs')
+            latencies.append((time.perf_counter() - start) * 1000)
+            time.sleep(0.005)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--uploads', type=int, default=4, help='concurrent upload threads')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds per mode')
+    parser.add_argument('--width', type=int, default=4032)
+    parser.add_argument('--height', type=int, default=3024)
+    parser.add_argument('--workers', type=int, default=4, help='preprocessing threads of the pool mode')
+    parser.add_argument('--queue-size', type=int, default=16, help='waiting uploads of the pool mode')
+    args = parser.parse_args()
+
+    image = synthetic_papyrus_image(args.width, args.height)
+    margin = min(args.width, args.height) // 10
+    right, bottom = args.width - margin, args.height - margin
+    coordinates = json.dumps([[margin, margin], [right, margin], [right, bottom], [margin, bottom]])
+
+    api.state.minio_client = InMemoryMinio(papyrus_retrieval.cfg.storage.buckets)
+    api.state.preprocess_pool = ThreadPoolExecutor(max_workers=args.workers)
+    api.state.preprocess_slots = asyncio.Semaphore(args.workers + args.queue_size)
+    papyrus_retrieval.papyrus_retrieval = lambda image_name, **options: SimpleNamespace(id=uuid.uuid4())
+    pooled = papyrus_retrieval.run_preprocessing
+    server, base_url = start_server()
+
+    print(f'{"mode":>10} {"uploads":>8} {"503":>5} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"max ms":>8}')
+    for mode in ('event-loop', 'pool'):
+        papyrus_retrieval.run_preprocessing = run_inline if mode == 'event-loop' else pooled
+        deadline = time.perf_counter() + args.duration
+        counts = {}
+        with ThreadPoolExecutor(max_workers=args.uploads) as uploads:
+            for _ in range(args.uploads):
+                uploads.submit(upload_loop, base_url, image, coordinates, deadline, counts)
+            latencies = light_loop(base_url, deadline)
+        print(
+            f'{mode:>10} {counts.get(200, 0):>8} {counts.get(503, 0):>5} '
+            + ' '.join(f'{np.percentile(latencies, q):>8.2f}' for q in (50, 95, 99, 100))
+        )
+
+    server.should_exit = True
+    api.state.preprocess_pool.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+"""
+In-process stand-ins for the external services (MinIO, Postgres/pgvector, LitServe) used by the benchmarks.
+
+They implement only the subset of the client interfaces the application code calls, so that benchmarks
+exercise the real application code paths without any running infrastructure.
+"""
+
+import io
+import time
+from typing import Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from src.database.search import Match, SearchBackend, TwoStageRetriever
+from src.health.health import Health, HealthMixin
+
+
+class _ObjectResponse(io.BytesIO):
+    def release_conn(self):
+        pass
+
+
+class _InMemoryObjectStore:
+    def __init__(self):
+        self.buckets: Dict[str, Dict[str, bytes]] = {}
+
+    def bucket_exists(self, bucket_name):
+        return bucket_name in self.buckets
+
+    def make_bucket(self, bucket_name):
+        self.buckets.setdefault(bucket_name, {})
+
+    def list_buckets(self):
+        return list(self.buckets)
+
+    def put_object(self, bucket_name, object_name, data, length, content_type=None):
+        self.buckets.setdefault(bucket_name, {})[object_name] = data.read(length)
+
+    def get_object(self, bucket_name, object_name):
+        return _ObjectResponse(self.buckets[bucket_name][object_name])
+
+
+class InMemoryMinio(HealthMixin):
+    """Stand-in for :class:`src.storage.minio.MinioClient`."""
+
+    def __init__(self, buckets: List[str]):
+        self.client = _InMemoryObjectStore()
+        for bucket_name in buckets:
+            self.client.make_bucket(bucket_name)
+
+    def health(self) -> Health:
+        return Health.OK
+
+
+class _InMemorySearchBackend(SearchBackend):
+    def __init__(self, vectors: np.ndarray, urls: List[str], latency_ms: float):
+        self.vectors = vectors
+        self.urls = urls
+        self.latency_ms = latency_ms
+
+    def search(self, embedding: List[float], k: int, exact: bool = False) -> List[str]:
+        return [self.urls[i] for i in self._nearest([embedding], k)[0]]
+
+    def candidates(self, embedding: List[float], n: int) -> Tuple[List[str], np.ndarray]:
+        return self.candidates_batch([embedding], n)[0]
+
+    def candidates_batch(self, embeddings: List[List[float]], n: int) -> List[Tuple[List[str], np.ndarray]]:
+        return [([self.urls[i] for i in top], self.vectors[top]) for top in self._nearest(embeddings, n)]
+
+    def _nearest(self, embeddings: List[List[float]], k: int) -> np.ndarray:
+        time.sleep(self.latency_ms / 1000)
+        similarities = np.asarray(embeddings, dtype=np.float32) @ self.vectors.T
+        k = min(k, len(self.urls))
+        top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        order = np.argsort(-np.take_along_axis(similarities, top, axis=1), axis=1)
+        return np.take_along_axis(top, order, axis=1)
+
+
+class _InMemoryEmbeddingRepository:
+    def __init__(self, search_backend: SearchBackend):
+        self.search_backend = search_backend
+        self.retriever = TwoStageRetriever(search_backend)
+
+    def get_k_nearest_embeddings(self, embedding: List[float], k: int, exact: bool = False) -> List[str]:
+        return self.search_backend.search(embedding, k, exact)
+
+    def get_matches(self, embedding: List[float], k: int, min_similarity: Optional[float] = None) -> List[Match]:
+        return self.retriever.match(embedding, k, min_similarity)
+
+    def get_matches_batch(
+        self, embeddings: List[List[float]], k: int, min_similarity: Optional[float] = None
+    ) -> List[List[Match]]:
+        return self.retriever.match_batch(embeddings, k, min_similarity)
+
+
+class InMemoryDatabase(HealthMixin):
+    """Stand-in for :class:`src.database.postgres.Postgres` backed by a synthetic embedding table."""
+
+    def __init__(self, size: int, latency_ms: float = 0.0, seed: int = 0):
+        vectors, urls = synthetic_embedding_table(size, seed)
+        search_backend = _InMemorySearchBackend(vectors, urls, latency_ms)
+        self.papyrus_embedding_repository = _InMemoryEmbeddingRepository(search_backend)
+
+    def health(self) -> Health:
+        return Health.OK
+
+
+def synthetic_embedding_table(size: int, seed: int = 0) -> Tuple[np.ndarray, List[str]]:
+    """Random L2 normalized embeddings of shape [size, 128] and their reference urls."""
+    vectors = np.random.default_rng(seed).normal(size=(size, 128)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    urls = [f'https://digi.ub.uni-heidelberg.de/diglit/p_synthetic_{i}/0001/_image' for i in range(size)]
+    return vectors, urls
+
+
+def fake_embedding(image_data: bytes, latency_ms: float = 0.0) -> Dict[str, List[float]]:
+    """
+    Stand-in for the ``/predict`` endpoint: a deterministic 128-d embedding derived from the decoded image.
+
+    :param image_data: Encoded image as sent to the inference server.
+    :param latency_ms: Simulated model forward pass duration.
+    """
+    time.sleep(latency_ms / 1000)
+    image = cv2.imdecode(np.frombuffer(image_data, np.uint8), cv2.IMREAD_GRAYSCALE)
+    embedding = cv2.resize(image, (16, 8), interpolation=cv2.INTER_AREA).astype(np.float32).ravel()
+    embedding -= embedding.mean()
+    embedding /= np.linalg.norm(embedding) or 1.0
+    return {'embedding': embedding.tolist()}
+
+
+def synthetic_papyrus_image(width: int = 1600, height: int = 1200, seed: int = 0) -> bytes:
+    """Generate a JPEG encoded, papyrus-coloured noise image with dark strokes imitating script."""
+    rng = np.random.default_rng(seed)
+    image = np.empty((height, width, 3), dtype=np.uint8)
+    image[:] = (120, 170, 200)  # BGR beige
+    noise = rng.normal(scale=18, size=(height, width, 1))
+    image = np.clip(image + noise, 0, 255).astype(np.uint8)
+    for _ in range(60):
+        x, y = int(rng.integers(0, width)), int(rng.integers(0, height))
+        cv2.line(image, (x, y), (x + int(rng.integers(-80, 80)), y + int(rng.integers(-10, 10))), (40, 50, 60), 3)
+    is_success, buffer = cv2.imencode('.jpg', image)
+    if not is_success:
+        raise ValueError('Failed to encode image')
+    return buffer.tobytes()
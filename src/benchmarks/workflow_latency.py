@@ -0,0 +1,60 @@
+"""
+End-to-end latency of the chained versus the fused retrieval workflow.
+
+Celery runs eagerly and MinIO, Postgres and the inference server are replaced by the in-process stand-ins
+of :mod:`src.benchmarks.stand_ins`. The delay a real deployment adds for every task hop (broker pickup and
+result backend write) is simulated with ``--hop-ms`` per executed task.
+
+Example::
+
+    python -m src.benchmarks.workflow_latency --runs 200 --hop-ms 5 --inference-ms 30
+"""
+
+import argparse
+import time
+from functools import partial
+from types import SimpleNamespace
+
+import numpy as np
+from celery.signals import task_prerun
+
+from src.benchmarks.stand_ins import InMemoryDatabase, InMemoryMinio, fake_embedding, synthetic_papyrus_image
+from src.tasks import workflow_tasks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=100)
+    parser.add_argument('--table-size', type=int, default=10000, help='rows of the synthetic embedding table')
+    parser.add_argument('--hop-ms', type=float, default=5.0, help='simulated queue latency per task')
+    parser.add_argument('--inference-ms', type=float, default=0.0, help='simulated model latency')
+    parser.add_argument('--search-ms', type=float, default=0.0, help='simulated database latency')
+    args = parser.parse_args()
+
+    workflow_tasks.celery.conf.task_always_eager = True
+    workflow_tasks.celery.conf.task_eager_propagates = True
+    workflow_tasks.cfg.cache.enabled = False  # every run should pay for the full workflow
+    workflow_tasks._publisher = SimpleNamespace(publish=lambda channel, message: 0)  # no Redis to announce to
+    task_prerun.connect(lambda **kwargs: time.sleep(args.hop_ms / 1000), weak=False)
+
+    bucket_name = workflow_tasks.cfg.storage.buckets[0]
+    workflow_tasks._minio_client = InMemoryMinio(workflow_tasks.cfg.storage.buckets)
+    workflow_tasks._database = InMemoryDatabase(args.table_size, latency_ms=args.search_ms)
+    workflow_tasks.send_image_to_litserve = partial(fake_embedding, latency_ms=args.inference_ms)
+
+    image = synthetic_papyrus_image(width=640, height=480)
+    workflow_tasks._minio_client.client.buckets[bucket_name]['query.jpg'] = image
+
+    print(f'{"workflow":>10} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8}')
+    for workflow in ('chain', 'fused'):
+        workflow_tasks.cfg.worker.workflow = workflow
+        latencies = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            workflow_tasks.papyrus_retrieval('query.jpg').get()
+            latencies.append((time.perf_counter() - start) * 1000)
+        print(f'{workflow:>10} ' + ' '.join(f'{np.percentile(latencies, q):>8.2f}' for q in (50, 95, 99)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+import json
+import logging
+import time
+from typing import Any, Optional
+
+from omegaconf import DictConfig
+from redis import Redis
+from redis.exceptions import RedisError
+
+from src.health.health import HealthMixin, Health
+from src.metrics.prometheus import CACHE_REQUESTS
+
+log = logging.getLogger(__name__)
+
+
+class RedisCache(HealthMixin):
+    """
+    Size capped key-value cache with expiry on top of Redis.
+
+    Every named cache keeps an index of its keys ordered by insertion time, which is used to evict
+    the oldest entries once ``max_entries`` is exceeded. Hits and misses are counted per cache in
+    ``papyrus_cache_requests_total``.
+    """
+
+    def __init__(self, url: str, ttl: int, max_entries: int, namespace: str = 'papyrus:cache'):
+        self.client = Redis.from_url(url)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.namespace = namespace
+
+    def get(self, name: str, key: str) -> Optional[Any]:
+        """
+        Look up a cached value and count the hit or miss.
+
+        :param name: Name of the cache, e.g. ``embedding``.
+        :param key: Key within the cache.
+        :return: The cached value or None on a miss.
+        """
+        value = self.client.get(self._key(name, key))
+        CACHE_REQUESTS.labels(name, 'miss' if value is None else 'hit').inc()
+        return None if value is None else json.loads(value)
+
+    def set(self, name: str, key: str, value: Any) -> None:
+        """
+        Cache a JSON serializable value and evict the oldest entries above the size cap.
+
+        :param name: Name of the cache, e.g. ``embedding``.
+        :param key: Key within the cache.
+        :param value: The value to cache.
+        """
+        cache_key = self._key(name, key)
+        index_key = self._index_key(name)
+        now = time.time()
+        pipeline = self.client.pipeline()
+        pipeline.set(cache_key, json.dumps(value), ex=self.ttl)
+        pipeline.zadd(index_key, {cache_key: now})
+        pipeline.zremrangebyscore(index_key, '-inf', now - self.ttl)  # entries expired by Redis already
+        pipeline.zcard(index_key)
+        size = pipeline.execute()[-1]
+
+        if size > self.max_entries:
+            evicted = [member for member, _ in self.client.zpopmin(index_key, size - self.max_entries)]
+            self.client.delete(*evicted)
+            log.debug(f'Evicted {len(evicted)} entries from the "{name}" cache')
+
+    def clear(self, name: str) -> int:
+        """
+        Delete all entries of a cache, e.g. the search results once the indexed embeddings changed.
+
+        :param name: Name of the cache, e.g. ``search``.
+        :return: Number of deleted entries.
+        """
+        index_key = self._index_key(name)
+        keys = self.client.zrange(index_key, 0, -1)
+        pipeline = self.client.pipeline()
+        for start in range(0, len(keys), 1000):
+            pipeline.delete(*keys[start : start + 1000])
+        pipeline.delete(index_key)
+        pipeline.execute()
+        log.info(f'Cleared {len(keys)} entries of the "{name}" cache')
+        return len(keys)
+
+    def health(self) -> Health:
+        try:
+            self.client.ping()
+            return Health.OK
+        except RedisError:
+            log.error('Redis interaction not possible')
+            return Health.NOT_OK
+
+    def _key(self, name: str, key: str) -> str:
+        return f'{self.namespace}:{name}:{key}'
+
+    def _index_key(self, name: str) -> str:
+        return f'{self.namespace}:{name}:index'
+
+    @staticmethod
+    def from_config(cfg: DictConfig) -> 'RedisCache':
+        return RedisCache(url=cfg.cache.url, ttl=cfg.cache.ttl, max_entries=cfg.cache.max_entries)
@@ -0,0 +1,23 @@
+import functools
+import os
+from pathlib import Path
+
+from omegaconf import DictConfig
+
+config_dir = os.getenv('PAPYRUS_APP_CONFIG_DIR', str(Path('config').absolute()))
+
+
+@functools.cache
+def get_config(*overrides: str) -> DictConfig:
+    """
+    The application config, composed by Hydra on first use and shared by all modules afterwards.
+
+    :param overrides: Hydra override strings, e.g. ``database.search.backend=pgvector``. Every
+        combination is composed once.
+    """
+    from hydra import compose, initialize_config_dir
+    from hydra.core.global_hydra import GlobalHydra
+
+    if not GlobalHydra.instance().is_initialized():
+        initialize_config_dir(config_dir=config_dir, version_base=None)
+    return compose(config_name='config', overrides=list(overrides))
@@ -5,13 +5,35 @@ from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import scoped_session, sessionmaker
 
 from src.database.repository import PapyrusEmbeddingRepository
+from src.database.search import TwoStageRetriever, create_search_backend
 from src.health.health import HealthMixin, Health
 
 log = logging.getLogger(__name__)
 
 
 class Postgres(HealthMixin):
-    def __init__(self, database, host, user, password, port):
+    def __init__(
+        self,
+        database,
+        host,
+        user,
+        password,
+        port,
+        search_backend='pgvector',
+        ef_search=40,
+        probes=1,
+        precision='full',
+        snapshot_dir='snapshots/papyrus_embedding',
+        refresh_interval=60,
+        rerank_candidates=100,
+        rerank_probe=10,
+        clear_similarity=0.95,
+        clear_margin=0.05,
+        pool_size=5,
+        max_overflow=10,
+        pool_pre_ping=True,
+        pool_recycle=1800,
+    ):
         url = URL.create(
             'postgresql',
             username=user,
@@ -20,9 +42,31 @@ class Postgres(HealthMixin):
             port=port,
             database=database,
         )
-        engine = create_engine(url)
+        engine = create_engine(
+            url,
+            pool_size=pool_size,
+            max_overflow=max_overflow,
+            pool_pre_ping=pool_pre_ping,
+            pool_recycle=pool_recycle,
+        )
         self.session_f = scoped_session(sessionmaker(autoflush=True, bind=engine))
-        self.papyrus_embedding_repository = PapyrusEmbeddingRepository(self.session_f)
+        search = create_search_backend(
+            search_backend,
+            self.session_f,
+            ef_search=ef_search,
+            probes=probes,
+            precision=precision,
+            snapshot_dir=snapshot_dir,
+            refresh_interval=refresh_interval,
+        )
+        retriever = TwoStageRetriever(
+            search,
+            candidates=rerank_candidates,
+            probe=rerank_probe,
+            clear_similarity=clear_similarity,
+            clear_margin=clear_margin,
+        )
+        self.papyrus_embedding_repository = PapyrusEmbeddingRepository(self.session_f, search, retriever)
 
     def health(self):
         with self.session_f() as session:
@@ -41,4 +85,18 @@ class Postgres(HealthMixin):
             user=cfg.database.user,
             password=cfg.database.password,
             port=cfg.database.port,
+            search_backend=cfg.database.search.backend,
+            ef_search=cfg.database.search.ef_search,
+            probes=cfg.database.search.probes,
+            precision=cfg.database.search.precision,
+            snapshot_dir=cfg.database.search.snapshot_dir,
+            refresh_interval=cfg.database.search.refresh_interval,
+            rerank_candidates=cfg.database.search.rerank.candidates,
+            rerank_probe=cfg.database.search.rerank.probe,
+            clear_similarity=cfg.database.search.rerank.clear_similarity,
+            clear_margin=cfg.database.search.rerank.clear_margin,
+            pool_size=cfg.database.pool.size,
+            max_overflow=cfg.database.pool.max_overflow,
+            pool_pre_ping=cfg.database.pool.pre_ping,
+            pool_recycle=cfg.database.pool.recycle,
         )
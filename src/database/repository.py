@@ -1,14 +1,32 @@
+import io
 import logging
 import uuid
-from typing import TypeVar, Generic, Optional, Type, List, Any, get_origin, get_args
+from typing import (
+    TypeVar,
+    Generic,
+    Optional,
+    Type,
+    List,
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    TYPE_CHECKING,
+    get_origin,
+    get_args,
+)
 from uuid import UUID
 
-from sqlalchemy import Column, UUID as AlchemyUUID, DateTime, func, String
+from sqlalchemy import Column, UUID as AlchemyUUID, Computed, DateTime, func, String, Index
 from sqlalchemy.exc import ProgrammingError, OperationalError
 from sqlalchemy.orm import declarative_base, scoped_session
-from pgvector.sqlalchemy import Vector
+from pgvector.sqlalchemy import BIT, HALFVEC, Vector
 from sqlalchemy import text
 
+from src.metrics.prometheus import BATCH_SIZE, timed
+
+if TYPE_CHECKING:
+    from src.database.search import Match, SearchBackend, TwoStageRetriever
 
 log = logging.getLogger(__name__)
 
@@ -25,7 +43,10 @@ class PapyrusEmbeddingEntity(Base):
         nullable=False,
         default=lambda: uuid.uuid4(),
     )
-    url = Column(String, nullable=False)
+    url = Column(String, nullable=False, unique=True, index=True)
+    # sha256 of the indexed image file and the model that embedded it, used to skip unchanged images
+    content_hash = Column(String(64))
+    model_version = Column(String)
 
     created_at = Column(
         DateTime(timezone=True),
@@ -38,6 +59,33 @@ class PapyrusEmbeddingEntity(Base):
     )
 
     embedding = Column(Vector(128), nullable=False)
+    # Compact copies of the embedding for smaller indexes, kept in sync by Postgres
+    embedding_half = Column(HALFVEC(128), Computed('CAST(embedding AS halfvec(128))', persisted=True))
+    embedding_bit = Column(BIT(128), Computed('CAST(binary_quantize(embedding) AS bit(128))', persisted=True))
+
+    __table_args__ = (
+        Index(
+            'ix_papyrus_embedding_embedding_hnsw',
+            'embedding',
+            postgresql_using='hnsw',
+            postgresql_with={'m': 16, 'ef_construction': 64},
+            postgresql_ops={'embedding': 'vector_cosine_ops'},
+        ),
+        Index(
+            'ix_papyrus_embedding_embedding_half_hnsw',
+            'embedding_half',
+            postgresql_using='hnsw',
+            postgresql_with={'m': 16, 'ef_construction': 64},
+            postgresql_ops={'embedding_half': 'halfvec_cosine_ops'},
+        ),
+        Index(
+            'ix_papyrus_embedding_embedding_bit_hnsw',
+            'embedding_bit',
+            postgresql_using='hnsw',
+            postgresql_with={'m': 16, 'ef_construction': 64},
+            postgresql_ops={'embedding_bit': 'bit_hamming_ops'},
+        ),
+    )
 
 
 T_co = TypeVar('T_co', bound=Base)
@@ -79,9 +127,34 @@ class Repository(Generic[T_co]):
             return session.query(self._model).filter(self._model.id == id).first()
 
     def list(self, skip: int = 0, limit: int = 100) -> List[T_co]:
+        """OFFSET pagination, its cost grows with ``skip``. Prefer :meth:`list_after` to page through a table."""
         with self.session_f() as session:
             return session.query(self._model).offset(skip).limit(limit).all()
 
+    def list_after(self, after: Optional[UUID] = None, limit: int = 100) -> List[T_co]:
+        """
+        Keyset pagination: the next page ordered by id, served by a range scan of the primary key index
+        whatever the position in the table.
+
+        :param after: Id of the last row of the previous page, None for the first page.
+        :param limit: Page size.
+        """
+        with self.session_f() as session:
+            query = session.query(self._model).order_by(self._model.id)
+            if after is not None:
+                query = query.filter(self._model.id > after)
+            return query.limit(limit).all()
+
+    def iterate(self, batch_size: int = 1000) -> Iterator[List[T_co]]:
+        """
+        Iterate over all rows in pages of ``batch_size`` with :meth:`list_after`. Each page is read in
+        its own short transaction, rows written meanwhile may or may not be included.
+        """
+        after = None
+        while page := self.list_after(after, batch_size):
+            yield page
+            after = page[-1].id
+
     def save(self, obj: T_co) -> T_co:
         with self.session_f() as session:
             obj = session.merge(obj)
@@ -100,6 +173,11 @@ class RepositorySchemaVerificationException(Exception):
 
 
 class PapyrusEmbeddingRepository(Repository[PapyrusEmbeddingEntity]):
+    def __init__(self, session_f: scoped_session, search_backend: 'SearchBackend', retriever: 'TwoStageRetriever'):
+        self.search_backend = search_backend
+        self.retriever = retriever
+        super().__init__(session_f)
+
     def get_by_url(self, url: str) -> Optional[PapyrusEmbeddingEntity]:
         """
         Retrieve a PapyrusEmbeddingEntity by its url.
@@ -110,35 +188,44 @@ class PapyrusEmbeddingRepository(Repository[PapyrusEmbeddingEntity]):
         with self.session_f() as session:
             return session.query(self._model).filter(self._model.url == url).first()
 
-    def get_k_nearest_embeddings(self, embedding: List[float], k: int) -> List[PapyrusEmbeddingEntity]:
+    def get_k_nearest_embeddings(self, embedding: List[float], k: int, exact: bool = False) -> List[str]:
         """
         Retrieve the top k nearest embeddings based on cosine similarity.
 
         :param embedding: The query embedding as a list of floats.
         :param k: Number of nearest neighbors to retrieve.
-        :return: List of PapyrusEmbeddingEntity objects corresponding to the top k nearest embeddings.
+        :param exact: Compute the exact nearest neighbours even if the search backend is approximate.
+        :return: List of urls corresponding to the top k nearest embeddings.
         """
-        with self.session_f() as session:
-            query = text(f"""
-            SELECT url,
-                1 - (embedding <=> CAST(:embedding AS vector)) AS cosine_similarity
-            FROM {self._model.__tablename__}
-            ORDER BY 1 - (embedding <=> CAST(:embedding AS vector)) DESC  -- Order by cosine similarity, descending
-            LIMIT :k
-            """)
-            log.info(f'Query: {query}')
-            log.info(f'Params: embedding={embedding}, k={k}')
-            log.info(f'Type of embedding: {type(embedding)}')
-            log.info(f'Type of k: {type(k)}')
-
-            result = session.execute(query, {'embedding': embedding, 'k': k}).fetchall()
-
-            # Log the cosine similarity values
-            for row in result:
-                log.info(f'URL: {row[0]}, Cosine Similarity: {row[1]}')
-
-            urls = [row[0] for row in result]
-            return urls
+        with timed('database', 'knn'):
+            return self.search_backend.search(embedding, k, exact)
+
+    def get_matches(self, embedding: List[float], k: int, min_similarity: Optional[float] = None) -> List['Match']:
+        """
+        Retrieve the top k matches with their exact cosine similarity, see :class:`TwoStageRetriever`.
+
+        :param embedding: The query embedding as a list of floats.
+        :param k: Number of matches to retrieve at most.
+        :param min_similarity: Drop matches below this cosine similarity.
+        :return: Matches ordered by descending similarity.
+        """
+        with timed('database', 'match'):
+            return self.retriever.match(embedding, k, min_similarity)
+
+    def get_matches_batch(
+        self, embeddings: List[List[float]], k: int, min_similarity: Optional[float] = None
+    ) -> List[List['Match']]:
+        """
+        Retrieve the top k matches of several query embeddings, with the candidates fetched in one round trip.
+
+        :param embeddings: The query embeddings.
+        :param k: Number of matches to retrieve at most per query.
+        :param min_similarity: Drop matches below this cosine similarity.
+        :return: One list of matches per query embedding, in the order of the queries.
+        """
+        BATCH_SIZE.labels('knn').observe(len(embeddings))
+        with timed('database', 'match_batch'):
+            return self.retriever.match_batch(embeddings, k, min_similarity)
 
     def update_embedding(self, id: UUID, new_embedding: List[float]) -> Optional[PapyrusEmbeddingEntity]:
         """
@@ -167,6 +254,72 @@ class PapyrusEmbeddingRepository(Repository[PapyrusEmbeddingEntity]):
             session.query(self._model).filter(self._model.url == url).delete()
             session.commit()
 
+    def get_content_hashes(self, model_version: str) -> Dict[str, str]:
+        """
+        Retrieve the content hash of every row embedded by a given model.
+
+        :param model_version: The model version the rows must have been embedded with.
+        :return: Mapping of url to content hash.
+        """
+        with self.session_f() as session:
+            rows = session.query(self._model.url, self._model.content_hash).filter(
+                self._model.model_version == model_version
+            )
+            return {url: content_hash for url, content_hash in rows}
+
+    def copy_upsert(self, entities: Iterable[PapyrusEmbeddingEntity]) -> int:
+        """
+        Insert or update multiple PapyrusEmbeddingEntities by url.
+
+        Rows are loaded with COPY into a transaction local staging table and merged with a single
+        ``INSERT ... ON CONFLICT``, which is much faster than :meth:`bulk_insert` for large batches.
+        The entities are serialized while COPY consumes them, so any iterable is loaded in constant
+        memory. Inserted and updated rows are stamped with the current time, whatever timestamps the
+        entities carry, so readers tracking ``modified_at`` see every upserted row. If a url occurs several
+        times, the entity with the latest ``modified_at`` wins.
+
+        :param entities: PapyrusEmbeddingEntity objects to insert or update.
+        :return: Number of entities loaded.
+        """
+        table = self._model.__tablename__
+        columns = 'id, url, content_hash, model_version, created_at, modified_at, embedding'
+        count = 0
+
+        def lines():
+            nonlocal count
+            for count, entity in enumerate(entities, start=1):
+                embedding = ','.join(str(float(value)) for value in entity.embedding)
+                values = [
+                    str(entity.id or uuid.uuid4()),
+                    entity.url,
+                    entity.content_hash,
+                    entity.model_version,
+                    entity.created_at.isoformat() if entity.created_at else None,
+                    entity.modified_at.isoformat() if entity.modified_at else None,
+                ]
+                yield '\t'.join(_copy_escape(value) for value in values) + f'\t[{embedding}]\n'
+
+        with self.session_f() as session:
+            session.execute(text(f'CREATE TEMP TABLE {table}_staging (LIKE {table}) ON COMMIT DROP'))
+            cursor = session.connection().connection.cursor()
+            cursor.copy_expert(f'COPY {table}_staging ({columns}) FROM STDIN', _LineReader(lines()))
+            session.execute(
+                text(f"""
+                INSERT INTO {table} ({columns})
+                SELECT DISTINCT ON (url)
+                    id, url, content_hash, model_version, now(), now(), embedding
+                FROM {table}_staging
+                ORDER BY url, modified_at DESC NULLS LAST
+                ON CONFLICT (url) DO UPDATE SET
+                    embedding = EXCLUDED.embedding,
+                    content_hash = EXCLUDED.content_hash,
+                    model_version = EXCLUDED.model_version,
+                    modified_at = now()
+                """)
+            )
+            session.commit()
+        return count
+
     def bulk_insert(self, entities: List[PapyrusEmbeddingEntity]) -> None:
         """
         Bulk insert multiple PapyrusEmbeddingEntities.
@@ -176,3 +329,35 @@ class PapyrusEmbeddingRepository(Repository[PapyrusEmbeddingEntity]):
         with self.session_f() as session:
             session.bulk_save_objects(entities)
             session.commit()
+
+
+def _copy_escape(value: Optional[str]) -> str:
+    """Escape a value for the text format of COPY."""
+    if value is None:
+        return '\\N'
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+class _LineReader(io.TextIOBase):
+    """Read-only file over an iterator of lines, so that COPY FROM STDIN pulls rows as they are produced."""
+
+    def __init__(self, lines: Iterator[str]):
+        self._lines = lines
+        self._buffer = ''
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: Optional[int] = -1) -> str:
+        if size is None or size < 0:
+            data, self._buffer = self._buffer + ''.join(self._lines), ''
+            return data
+        chunks, length = [self._buffer], len(self._buffer)
+        for line in self._lines:
+            chunks.append(line)
+            length += len(line)
+            if length >= size:
+                break
+        data = ''.join(chunks)
+        data, self._buffer = data[:size], data[size:]
+        return data
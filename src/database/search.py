@@ -0,0 +1,438 @@
+import json
+import logging
+import os
+import threading
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+from pgvector.sqlalchemy import Vector
+from sqlalchemy import Integer, String, text
+from sqlalchemy.orm import scoped_session
+
+from src.database.repository import PapyrusEmbeddingEntity
+from src.database.snapshot import ensure_snapshot, normalize, read_current_version, update_snapshot
+
+log = logging.getLogger(__name__)
+
+
+class SearchBackend(ABC):
+    @abstractmethod
+    def search(self, embedding: List[float], k: int, exact: bool = False) -> List[str]:
+        """
+        Retrieve the urls of the top k nearest embeddings based on cosine similarity.
+
+        :param embedding: The query embedding as a list of floats.
+        :param k: Number of nearest neighbors to retrieve.
+        :param exact: Compute the exact nearest neighbours even if the backend is approximate.
+        :return: List of urls ordered by descending similarity.
+        """
+        pass
+
+    @abstractmethod
+    def candidates(self, embedding: List[float], n: int) -> Tuple[List[str], np.ndarray]:
+        """
+        Coarse stage of :class:`TwoStageRetriever`: up to n approximate nearest neighbours, as cheap as the
+        backend allows.
+
+        :param embedding: The query embedding.
+        :param n: Number of candidates.
+        :return: The candidate urls and their embeddings of shape [n, 128], in no particular order.
+        """
+        pass
+
+    def candidates_batch(self, embeddings: List[List[float]], n: int) -> List[Tuple[List[str], np.ndarray]]:
+        """
+        :meth:`candidates` of several query embeddings at once.
+
+        :return: One pair of candidate urls and embeddings per query embedding, in the order of the queries.
+        """
+        return [self.candidates(embedding, n) for embedding in embeddings]
+
+
+class Match(NamedTuple):
+    url: str
+    similarity: float  # cosine similarity to the query
+
+
+class TwoStageRetriever:
+    """
+    Retrieval of the top k matches with exact cosine scores.
+
+    The search backend supplies a pool of approximate candidates, which are re-ranked by their exact
+    cosine similarity in a single NumPy pass. A small probe of ``probe`` candidates is fetched first:
+    if its best k matches are all above ``clear_similarity`` and separated from the next candidate by
+    at least ``clear_margin``, the query has a clear answer and the full pool of ``candidates`` is never
+    fetched.
+    """
+
+    def __init__(
+        self,
+        backend: SearchBackend,
+        candidates: int = 100,
+        probe: int = 10,
+        clear_similarity: float = 0.95,
+        clear_margin: float = 0.05,
+    ):
+        self.backend = backend
+        self.candidates = candidates
+        self.probe = probe
+        self.clear_similarity = clear_similarity
+        self.clear_margin = clear_margin
+
+    def match(self, embedding: List[float], k: int, min_similarity: Optional[float] = None) -> List[Match]:
+        """
+        :param embedding: The query embedding.
+        :param k: Number of matches to return at most.
+        :param min_similarity: Drop matches below this cosine similarity.
+        :return: Matches ordered by descending similarity.
+        """
+        query = normalize(np.asarray(embedding, dtype=np.float32)[None])[0]
+        if k < self.probe < self.candidates:
+            urls, similarities = self._rerank(query, *self.backend.candidates(embedding, self.probe))
+            if self._is_clear(similarities, k):
+                return _matches(urls, similarities, k, min_similarity)
+        urls, similarities = self._rerank(query, *self.backend.candidates(embedding, max(k, self.candidates)))
+        return _matches(urls, similarities, k, min_similarity)
+
+    def match_batch(
+        self, embeddings: List[List[float]], k: int, min_similarity: Optional[float] = None
+    ) -> List[List[Match]]:
+        """
+        :meth:`match` of several query embeddings. The backend fetches the candidates of all queries at
+        once, so the full pool is fetched right away instead of probing first.
+
+        :return: One list of matches per query embedding, in the order of the queries.
+        """
+        if not embeddings:
+            return []
+        queries = normalize(np.asarray(embeddings, dtype=np.float32).reshape(len(embeddings), -1))
+        pools = self.backend.candidates_batch(embeddings, max(k, self.candidates))
+        return [
+            _matches(*self._rerank(query, urls, vectors), k, min_similarity)
+            for query, (urls, vectors) in zip(queries, pools)
+        ]
+
+    def _is_clear(self, similarities: np.ndarray, k: int) -> bool:
+        if len(similarities) <= k:
+            return False
+        return bool(
+            similarities[k - 1] >= self.clear_similarity and similarities[k - 1] - similarities[k] >= self.clear_margin
+        )
+
+    @staticmethod
+    def _rerank(query: np.ndarray, urls: List[str], vectors: np.ndarray) -> Tuple[List[str], np.ndarray]:
+        """Exact cosine similarity of all candidates, in descending order."""
+        if not urls:
+            return [], np.empty(0, np.float32)
+        similarities = normalize(np.asarray(vectors, dtype=np.float32)) @ query
+        order = np.argsort(-similarities)
+        return [urls[i] for i in order], similarities[order]
+
+
+def _matches(urls: List[str], similarities: np.ndarray, k: int, min_similarity: Optional[float]) -> List[Match]:
+    matches = [Match(url, float(similarity)) for url, similarity in zip(urls[:k], similarities[:k])]
+    if min_similarity is not None:
+        matches = [match for match in matches if match.similarity >= min_similarity]
+    return matches
+
+
+class PgvectorSearchBackend(SearchBackend):
+    """
+    k-NN query in Postgres, served by the HNSW/IVFFlat index on the embedding column.
+
+    ``precision`` selects the column the index scan runs on: ``full`` (float32 ``embedding``), ``half``
+    (``embedding_half``, float16) or ``binary`` (``embedding_bit``, one sign bit per dimension compared by
+    Hamming distance), both maintained by Postgres as generated columns. Their HNSW indexes are about 2x
+    and 32x smaller than the float32 one. Rows are always returned in the order of their full precision
+    cosine distance: with a compact column, the ``ef_search`` rows of the index scan are re-ranked.
+    """
+
+    precisions = ('full', 'half', 'binary')
+
+    def __init__(self, session_f: scoped_session, ef_search: int = 40, probes: int = 1, precision: str = 'full'):
+        if precision not in self.precisions:
+            raise ValueError(f'Unknown search precision "{precision}", expected one of {self.precisions}')
+        self.session_f = session_f
+        self.ef_search = ef_search
+        self.probes = probes
+        self.precision = precision
+
+    def search(self, embedding: List[float], k: int, exact: bool = False) -> List[str]:
+        """
+        The query orders by the raw distance operator so that the vector index can serve it.
+        Index scans are approximate; ``exact`` forces a full precision sequential scan which is useful
+        as ground truth when tuning ``ef_search``/``probes`` or comparing precisions.
+        """
+        with self.session_f() as session:
+            pool = self._configure_search(session, exact, k)
+            nearest = self._nearest_query(
+                'CAST(:embedding AS vector)', 'url, 1 - (embedding <=> CAST(:embedding AS vector))', exact
+            )
+            query = text(f'{nearest} LIMIT :k')
+            result = session.execute(query, {'embedding': embedding, 'k': k, 'pool': pool}).fetchall()
+
+        if result:
+            log.debug(f'Nearest of {len(result)} neighbours: {result[0][0]} with cosine similarity {result[0][1]:.4f}')
+        return [row[0] for row in result]
+
+    def candidates(self, embedding: List[float], n: int) -> Tuple[List[str], np.ndarray]:
+        """The full precision embeddings are returned whatever column the index scan ran on."""
+        with self.session_f() as session:
+            pool = self._configure_search(session, False, n)
+            nearest = self._nearest_query('CAST(:embedding AS vector)', 'url, embedding', exact=False)
+            query = text(f'{nearest} LIMIT :n').columns(url=String, embedding=Vector(128))
+            result = session.execute(query, {'embedding': embedding, 'n': n, 'pool': pool}).fetchall()
+        if not result:
+            return [], np.empty((0, 128), np.float32)
+        return [row[0] for row in result], np.stack([row[1] for row in result])
+
+    def candidates_batch(self, embeddings: List[List[float]], n: int) -> List[Tuple[List[str], np.ndarray]]:
+        """
+        All queries are answered by one statement: a LATERAL k-NN subquery per unnested query vector,
+        each of which is served by the vector index like a single query.
+        """
+        if not embeddings:
+            return []
+        with self.session_f() as session:
+            pool = self._configure_search(session, False, n)
+            nearest = self._nearest_query('q.query_embedding', 'url, embedding', exact=False)
+            query = text(f"""
+            SELECT q.ordinality - 1 AS query, nearest.url, nearest.embedding
+            FROM unnest(CAST(:embeddings AS vector[])) WITH ORDINALITY AS q(query_embedding, ordinality)
+            CROSS JOIN LATERAL ({nearest} LIMIT :n) AS nearest
+            """).columns(query=Integer, url=String, embedding=Vector(128))
+            # pgvector's text format, the array is cast element-wise to vector[]
+            vectors = [f'[{",".join(map(str, embedding))}]' for embedding in embeddings]
+            result = session.execute(query, {'embeddings': vectors, 'n': n, 'pool': pool}).fetchall()
+
+        rows = [([], []) for _ in embeddings]
+        for position, url, embedding in result:
+            rows[position][0].append(url)
+            rows[position][1].append(embedding)
+        return [(urls, np.stack(vectors) if vectors else np.empty((0, 128), np.float32)) for urls, vectors in rows]
+
+    def _nearest_query(self, query: str, columns: str, exact: bool) -> str:
+        """
+        SELECT of the rows nearest to a query vector expression, in ascending full precision distance.
+        The caller appends the LIMIT.
+
+        :param query: SQL expression of the query vector.
+        :param columns: Selected columns, computed from ``url`` and ``embedding``.
+        :param exact: Order by the float32 column, as the sequential scan does not profit from compact ones.
+        """
+        table = PapyrusEmbeddingEntity.__tablename__
+        precision = 'full' if exact else self.precision
+        if precision == 'full':
+            return f"""
+            SELECT {columns}
+            FROM {table}
+            ORDER BY embedding <=> {query}  -- Ascending distance, served by the vector index
+            """
+        coarse_distance = {
+            'half': f'embedding_half <=> CAST({query} AS halfvec(128))',
+            # 128 bit Hamming distances tie a lot, so re-ranking the index scan rows matters most here
+            'binary': f'embedding_bit <~> CAST(binary_quantize({query}) AS bit(128))',
+        }[precision]
+        # Only the :pool rows of the index scan on the compact column are compared at full precision
+        return f"""
+            SELECT {columns} FROM (
+                SELECT url, embedding
+                FROM {table}
+                ORDER BY {coarse_distance}
+                LIMIT :pool
+            ) AS coarse
+            ORDER BY embedding <=> {query}
+            """
+
+    def _configure_search(self, session, exact: bool, k: int) -> int:
+        """
+        Apply the vector index search parameters to the current transaction only.
+
+        An HNSW index scan returns at most ``hnsw.ef_search`` rows, so it is raised to k if needed.
+
+        :param session: The session whose transaction runs the k-NN query.
+        :param exact: Disable index scans for this transaction.
+        :param k: Number of rows the query needs.
+        :return: Number of rows to take from the index scan before re-ranking.
+        """
+        pool = max(k, self.ef_search)
+        settings = {'hnsw.ef_search': pool, 'ivfflat.probes': self.probes}
+        if exact:
+            settings['enable_indexscan'] = 'off'
+        # One round trip for all settings, set_config(..., true) is the function form of SET LOCAL
+        calls = ', '.join(f'set_config(:name_{i}, :value_{i}, true)' for i in range(len(settings)))
+        parameters = {}
+        for i, (name, value) in enumerate(settings.items()):
+            parameters[f'name_{i}'] = name
+            parameters[f'value_{i}'] = str(value)
+        session.execute(text(f'SELECT {calls}'), parameters)
+        return pool
+
+
+class _Index(NamedTuple):
+    vectors: np.ndarray  # memory mapped [N, 128], as stored in the table
+    inverse_norms: np.ndarray  # 1 / L2 norm of every row of vectors, 0 for zero vectors
+    urls: List[str]
+    positions: Dict[str, int]  # url -> row of vectors
+    superseded: np.ndarray  # rows of vectors replaced by a newer delta row
+    delta_urls: List[str]
+    delta_vectors: np.ndarray  # L2 normalized [M, 128]
+    watermark: datetime
+    version: str
+
+
+class MemoryMappedSearchBackend(SearchBackend):
+    """
+    Exact k-NN over a memory mapped snapshot of the ``papyrus_embedding`` table.
+
+    The snapshot is a directory of versioned ``vectors.npy``/``urls.json`` pairs written by
+    :func:`write_snapshot`. Because the vectors are memory mapped read-only, all worker processes
+    on a host share the same page cache pages. A background thread checks every ``refresh_interval``
+    seconds for a newer snapshot and for rows inserted or updated after it, which are searched as an
+    in-memory delta. The process holding the snapshot lock writes a new snapshot once the delta grows
+    large or rows were deleted, searches never wait for either.
+    """
+
+    # Rows committed late can carry a modified_at slightly before the watermark, re-read this window
+    refresh_overlap = timedelta(minutes=1)
+    # Share of the snapshot size the delta may reach before a new snapshot is written
+    max_delta_ratio = 0.1
+
+    def __init__(self, session_f: scoped_session, snapshot_dir: str, refresh_interval: float = 60.0):
+        self.session_f = session_f
+        self.snapshot_dir = snapshot_dir
+        self.refresh_interval = refresh_interval
+        ensure_snapshot(session_f, snapshot_dir)
+        self._index = self._load()
+        self._stopped = threading.Event()
+        self._refresher = threading.Thread(target=self._run, name='search-snapshot-refresh', daemon=True)
+        self._refresher.start()
+
+    def search(self, embedding: List[float], k: int, exact: bool = False) -> List[str]:
+        return self.candidates(embedding, k)[0]
+
+    def candidates(self, embedding: List[float], n: int) -> Tuple[List[str], np.ndarray]:
+        """The exact top n, the re-ranking merely adds the scores."""
+        return self.candidates_batch([embedding], n)[0]
+
+    def candidates_batch(self, embeddings: List[List[float]], n: int) -> List[Tuple[List[str], np.ndarray]]:
+        index, top = self._nearest(embeddings, n)
+        return [self._rows(index, positions) for positions in top]
+
+    @staticmethod
+    def _rows(index: _Index, top: np.ndarray) -> Tuple[List[str], np.ndarray]:
+        """Urls and vectors at positions of the index, past the snapshot they refer to the delta."""
+        snapshot_size = len(index.urls)
+        urls = [index.urls[i] if i < snapshot_size else index.delta_urls[i - snapshot_size] for i in top]
+        vectors = [index.vectors[i] if i < snapshot_size else index.delta_vectors[i - snapshot_size] for i in top]
+        if not vectors:
+            return [], np.empty((0, index.vectors.shape[1]), np.float32)
+        return urls, np.stack(vectors)
+
+    def _nearest(self, embeddings: List[List[float]], k: int) -> Tuple[_Index, np.ndarray]:
+        """
+        :return: The searched index and, per query, the positions of its k nearest live rows in descending
+            order of similarity. Positions past the snapshot refer to the delta.
+        """
+        index = self._index
+
+        queries = normalize(np.asarray(embeddings, dtype=np.float32).reshape(len(embeddings), -1))
+        similarities = (queries @ index.vectors.T) * index.inverse_norms  # [Q, N]
+        similarities[:, index.superseded] = -np.inf
+        if index.delta_urls:
+            similarities = np.concatenate([similarities, queries @ index.delta_vectors.T], axis=1)
+
+        # Superseded rows score -inf, but are still picked if k exceeds the number of live rows
+        k = min(k, similarities.shape[1] - int(index.superseded.sum()))
+        if k <= 0:
+            return index, np.empty((len(embeddings), 0), np.int64)
+        top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        top_similarities = np.take_along_axis(similarities, top, axis=1)
+        return index, np.take_along_axis(top, np.argsort(-top_similarities, axis=1), axis=1)
+
+    def refresh(self) -> None:
+        """Write a new snapshot if this process holds the lock and it is due, then pick up changes."""
+        update_snapshot(self.session_f, self.snapshot_dir, self.max_delta_ratio)
+        index = self._index
+        if read_current_version(self.snapshot_dir) != index.version:
+            index = self._load()
+        self._index = self._refresh_delta(index)
+
+    def close(self) -> None:
+        """Stop refreshing in the background."""
+        self._stopped.set()
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.refresh_interval):
+            try:
+                self.refresh()
+            except Exception as exc:
+                log.error(f'Failed to refresh the search snapshot: {exc}')
+
+    def _refresh_delta(self, index: _Index) -> _Index:
+        with self.session_f() as session:
+            rows = (
+                session.query(
+                    PapyrusEmbeddingEntity.url, PapyrusEmbeddingEntity.embedding, PapyrusEmbeddingEntity.modified_at
+                )
+                .filter(PapyrusEmbeddingEntity.modified_at > index.watermark - self.refresh_overlap)
+                .all()
+            )
+
+        delta = dict(zip(index.delta_urls, index.delta_vectors))
+        watermark = index.watermark
+        superseded = index.superseded.copy()
+        for url, embedding, modified_at in rows:
+            position = index.positions.get(url)
+            if position is not None:
+                superseded[position] = True
+            delta[url] = normalize(np.asarray(embedding, dtype=np.float32)[None])[0]
+            watermark = max(watermark, modified_at)
+
+        delta_vectors = np.stack(list(delta.values())) if delta else np.empty((0, index.vectors.shape[1]), np.float32)
+        return index._replace(
+            superseded=superseded, delta_urls=list(delta), delta_vectors=delta_vectors, watermark=watermark
+        )
+
+    def _load(self) -> _Index:
+        version = read_current_version(self.snapshot_dir)
+        path = os.path.join(self.snapshot_dir, version)
+        vectors = np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r')
+        norms_path = os.path.join(path, 'norms.npy')
+        # Snapshots without norms stored L2 normalized vectors
+        norms = np.load(norms_path) if os.path.exists(norms_path) else np.ones(len(vectors), np.float32)
+        with open(os.path.join(path, 'urls.json')) as file:
+            urls = json.load(file)
+        with open(os.path.join(path, 'meta.json')) as file:
+            watermark = datetime.fromisoformat(json.load(file)['watermark'])
+        log.info(f'Loaded search snapshot {version} with {len(urls)} embeddings')
+        return _Index(
+            vectors=vectors,
+            inverse_norms=np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0),
+            urls=urls,
+            positions={url: position for position, url in enumerate(urls)},
+            superseded=np.zeros(len(urls), dtype=bool),
+            delta_urls=[],
+            delta_vectors=np.empty((0, vectors.shape[1]), np.float32),
+            watermark=watermark,
+            version=version,
+        )
+
+
+def create_search_backend(name: str, session_f: scoped_session, **options) -> SearchBackend:
+    """
+    :param name: ``pgvector`` or ``mmap``.
+    :param options: ``ef_search``, ``probes`` and ``precision`` for pgvector, ``snapshot_dir`` and
+        ``refresh_interval`` for mmap.
+    """
+    if name == 'pgvector':
+        return PgvectorSearchBackend(
+            session_f, ef_search=options['ef_search'], probes=options['probes'], precision=options['precision']
+        )
+    if name == 'mmap':
+        return MemoryMappedSearchBackend(
+            session_f, snapshot_dir=options['snapshot_dir'], refresh_interval=options['refresh_interval']
+        )
+    raise ValueError(f'Unknown search backend "{name}", expected pgvector or mmap')
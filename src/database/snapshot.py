@@ -0,0 +1,303 @@
+"""
+Export and import of the ``papyrus_embedding`` table as a snapshot directory.
+
+A snapshot directory holds immutable versions and a ``CURRENT`` file naming the latest one. Every
+version contains:
+
+- ``vectors.npy``: float32 embeddings of shape [N, 128] as stored in the table, memory mapped by the
+  mmap search backend
+- ``norms.npy``: L2 norm of every row of ``vectors.npy``, so cosine similarities need no normalized copy
+- ``urls.json``: url of every row of ``vectors.npy``
+- ``rows.jsonl``: id, url, content hash, model version and timestamps of every row, one JSON object
+  per line in the order of ``vectors.npy``
+- ``meta.json``: row count and the latest ``modified_at`` (watermark)
+
+Versions are only written by the process holding the ``LOCK`` file of the directory. Once ``CURRENT``
+has moved on, all but the previous version are deleted.
+
+Both directions stream the rows, so memory use does not grow with the table size. A snapshot exported
+from one environment bootstraps another without re-embedding the corpus::
+
+    python -m src.database.snapshot export --snapshot-dir snapshots/papyrus_embedding
+    python -m src.database.snapshot import --snapshot-dir snapshots/papyrus_embedding
+
+and, pointed to by ``PAPYRUS_SEARCH_SNAPSHOT_DIR``, serves the mmap search backend right away.
+"""
+
+import argparse
+import fcntl
+import json
+import logging
+import os
+import shutil
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Iterator, Optional
+
+import numpy as np
+from sqlalchemy import func
+from sqlalchemy.orm import scoped_session
+
+from src.config import get_config
+from src.database.repository import PapyrusEmbeddingEntity, PapyrusEmbeddingRepository
+
+log = logging.getLogger(__name__)
+
+DIMENSIONS = 128
+# Versions kept besides the current one, processes that read CURRENT just before it moved still load them
+KEEP_PREVIOUS = 1
+
+
+def read_current_version(snapshot_dir: str) -> Optional[str]:
+    try:
+        with open(os.path.join(snapshot_dir, 'CURRENT')) as file:
+            return file.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+@contextmanager
+def snapshot_lock(snapshot_dir: str, blocking: bool = True) -> Iterator[bool]:
+    """
+    Exclusive lock of a snapshot directory, held while a version is written.
+
+    :param blocking: Wait for the lock, otherwise give up at once if another process holds it.
+    :return: Whether the lock was acquired.
+    """
+    os.makedirs(snapshot_dir, exist_ok=True)
+    with open(os.path.join(snapshot_dir, 'LOCK'), 'w') as file:
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        yield True  # released when the file is closed
+
+
+def write_snapshot(session_f: scoped_session, snapshot_dir: str, batch_size: int = 10000) -> str:
+    """
+    Write the ``papyrus_embedding`` table as a new snapshot version and make it the current one.
+
+    The rows are read through a server-side cursor in a repeatable read transaction and written to a
+    preallocated memory mapped ``vectors.npy`` as they arrive. Versions are immutable directories,
+    ``CURRENT`` is replaced atomically, so processes still mapping an older version are unaffected.
+
+    :param batch_size: Rows fetched from the cursor at a time.
+    :return: The new snapshot version.
+    """
+    with snapshot_lock(snapshot_dir):
+        return _write_version(session_f, snapshot_dir, batch_size)
+
+
+def ensure_snapshot(session_f: scoped_session, snapshot_dir: str) -> str:
+    """
+    The current snapshot version, written first if there is none yet.
+
+    Processes starting at the same time wait for the one writing the first version.
+    """
+    version = read_current_version(snapshot_dir)
+    if version is not None:
+        return version
+    with snapshot_lock(snapshot_dir):
+        return read_current_version(snapshot_dir) or _write_version(session_f, snapshot_dir)
+
+
+def update_snapshot(session_f: scoped_session, snapshot_dir: str, max_delta_ratio: float = 0.1) -> Optional[str]:
+    """
+    Write a new snapshot version if the current one is outdated, unless another process is writing one.
+
+    A snapshot is outdated once rows were deleted since it was written, or the rows changed since then
+    exceed ``max_delta_ratio`` of its size.
+
+    :return: The new snapshot version, None if none was written.
+    """
+    with snapshot_lock(snapshot_dir, blocking=False) as locked:
+        if not locked:
+            return None
+        version = read_current_version(snapshot_dir)
+        if version is not None and not _is_outdated(session_f, snapshot_dir, version, max_delta_ratio):
+            return None
+        log.info('Search snapshot is outdated, writing a new one')
+        return _write_version(session_f, snapshot_dir)
+
+
+def _is_outdated(session_f: scoped_session, snapshot_dir: str, version: str, max_delta_ratio: float) -> bool:
+    with open(os.path.join(snapshot_dir, version, 'meta.json')) as file:
+        meta = json.load(file)
+    watermark = datetime.fromisoformat(meta['watermark'])
+    entity = PapyrusEmbeddingEntity
+    with session_f() as session:
+        count, created, modified = session.query(
+            func.count(entity.id),
+            func.count(entity.id).filter(entity.created_at > watermark),
+            func.count(entity.id).filter(entity.modified_at > watermark),
+        ).one()
+    deleted = count < meta['count'] + created
+    return deleted or modified > max_delta_ratio * max(meta['count'], 1000)
+
+
+def _write_version(session_f: scoped_session, snapshot_dir: str, batch_size: int = 10000) -> str:
+    version = datetime.now().strftime('%Y%m%d%H%M%S%f')
+    path = os.path.join(snapshot_dir, version)
+    os.makedirs(path)
+
+    entity = PapyrusEmbeddingEntity
+    watermark = datetime.fromtimestamp(0, timezone.utc)
+    with session_f() as session:
+        # The count and the rows must come from the same snapshot of the table
+        session.connection(execution_options={'isolation_level': 'REPEATABLE READ'})
+        count = session.query(func.count(entity.id)).scalar()
+        vectors = np.lib.format.open_memmap(
+            os.path.join(path, 'vectors.npy'), mode='w+', dtype=np.float32, shape=(count, DIMENSIONS)
+        )
+        rows = session.query(
+            entity.id,
+            entity.url,
+            entity.content_hash,
+            entity.model_version,
+            entity.created_at,
+            entity.modified_at,
+            entity.embedding,
+        ).yield_per(batch_size)
+        urls = open(os.path.join(path, 'urls.json'), 'w')
+        lines = open(os.path.join(path, 'rows.jsonl'), 'w')
+        with urls, lines:
+            urls.write('[')
+            for position, row in enumerate(rows):
+                vectors[position] = row.embedding
+                urls.write(f'{", " if position else ""}{json.dumps(row.url)}')
+                attributes = {
+                    'id': str(row.id),
+                    'url': row.url,
+                    'content_hash': row.content_hash,
+                    'model_version': row.model_version,
+                    'created_at': _isoformat(row.created_at),
+                    'modified_at': _isoformat(row.modified_at),
+                }
+                lines.write(json.dumps(attributes) + '\n')
+                if row.modified_at is not None:
+                    watermark = max(watermark, row.modified_at)
+            urls.write(']')
+    vectors.flush()
+    norms = np.empty(count, dtype=np.float32)
+    for start in range(0, count, batch_size):
+        norms[start : start + batch_size] = np.linalg.norm(vectors[start : start + batch_size], axis=1)
+    np.save(os.path.join(path, 'norms.npy'), norms)
+    del vectors
+
+    with open(os.path.join(path, 'meta.json'), 'w') as file:
+        json.dump({'watermark': watermark.isoformat(), 'count': count}, file)
+
+    current = os.path.join(snapshot_dir, 'CURRENT')
+    with open(f'{current}.{version}', 'w') as file:
+        file.write(version)
+    os.replace(f'{current}.{version}', current)
+    log.info(f'Wrote search snapshot {version} with {count} embeddings')
+    _prune(snapshot_dir)
+    return version
+
+
+def _prune(snapshot_dir: str) -> None:
+    """Delete the versions superseded by the current and the previous ones."""
+    # Versions are timestamps, their names sort chronologically
+    versions = sorted(entry.name for entry in os.scandir(snapshot_dir) if entry.is_dir())
+    current = versions.index(read_current_version(snapshot_dir))
+    for version in versions[: max(current - KEEP_PREVIOUS, 0)]:
+        shutil.rmtree(os.path.join(snapshot_dir, version), ignore_errors=True)
+        log.info(f'Deleted search snapshot {version}')
+
+
+def read_snapshot(snapshot_dir: str, version: Optional[str] = None) -> Iterator[PapyrusEmbeddingEntity]:
+    """
+    Iterate over the rows of a snapshot version, reading one line and one memory mapped vector at a time.
+
+    Snapshots written by the mmap search backend before ``rows.jsonl`` existed only carry urls, their rows
+    get a new id and no content hash or model version. Their vectors were L2 normalized when written.
+
+    :param version: Defaults to the current version.
+    """
+    version = version or read_current_version(snapshot_dir)
+    if version is None:
+        raise FileNotFoundError(f'No snapshot in {snapshot_dir}')
+    path = os.path.join(snapshot_dir, version)
+    vectors = np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r')
+    rows_path = os.path.join(path, 'rows.jsonl')
+    if os.path.exists(rows_path):
+        with open(rows_path) as lines:
+            for line, vector in zip(lines, vectors):
+                row = json.loads(line)
+                yield PapyrusEmbeddingEntity(
+                    id=uuid.UUID(row['id']),
+                    url=row['url'],
+                    content_hash=row['content_hash'],
+                    model_version=row['model_version'],
+                    created_at=_parse_datetime(row['created_at']),
+                    modified_at=_parse_datetime(row['modified_at']),
+                    embedding=vector,
+                )
+    else:
+        with open(os.path.join(path, 'urls.json')) as file:
+            urls = json.load(file)
+        for url, vector in zip(urls, vectors):
+            yield PapyrusEmbeddingEntity(id=uuid.uuid4(), url=url, embedding=vector)
+
+
+def import_snapshot(repository: PapyrusEmbeddingRepository, snapshot_dir: str, version: Optional[str] = None) -> int:
+    """
+    Upsert the rows of a snapshot version into ``papyrus_embedding`` with a single streamed COPY.
+
+    Ids are kept for new urls. All imported rows are stamped with the import time, so running mmap
+    search backends pick them up and their snapshots count as outdated.
+
+    :return: Number of rows imported.
+    """
+    count = repository.copy_upsert(read_snapshot(snapshot_dir, version))
+    log.info(f'Imported {count} embeddings from {snapshot_dir}')
+    return count
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1.0, norms)
+
+
+def _isoformat(value: Optional[datetime]) -> Optional[str]:
+    return value.isoformat() if value is not None else None
+
+
+def _parse_datetime(value: Optional[str]) -> Optional[datetime]:
+    return datetime.fromisoformat(value) if value is not None else None
+
+
+def main():
+    from src.cache.redis import RedisCache
+    from src.database.postgres import Postgres  # imports this module through the search backends
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['export', 'import'])
+    parser.add_argument('--snapshot-dir', default=None, help='defaults to database.search.snapshot_dir')
+    parser.add_argument('--version', default=None, help='snapshot version to import, defaults to the current one')
+    parser.add_argument('--batch-size', type=int, default=10000, help='rows fetched at a time by the export')
+    args = parser.parse_args()
+
+    # Connect without the mmap search backend, which would build its index from the snapshot directory
+    cfg = get_config('database.search.backend=pgvector')
+    snapshot_dir = args.snapshot_dir or cfg.database.search.snapshot_dir
+    database = Postgres.from_config(cfg)
+    if args.command == 'export':
+        version = write_snapshot(database.session_f, snapshot_dir, args.batch_size)
+        print(f'Exported snapshot {version} to {snapshot_dir}')
+    else:
+        count = import_snapshot(database.papyrus_embedding_repository, snapshot_dir, args.version)
+        if cfg.cache.enabled:
+            # Cached results predate the imported rows, which may come from another model
+            cache = RedisCache.from_config(cfg)
+            cache.clear('embedding')
+            cache.clear('search')
+        print(f'Imported {count} embeddings from {snapshot_dir}')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,91 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, Optional
+
+from src.health.health import Health
+from src.metrics.prometheus import COMPONENT_UP, HEALTH_CHECK_SECONDS
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class ComponentHealth:
+    status: Health
+    latency_ms: Optional[float] = None  # duration of the last check
+    checked_at: Optional[datetime] = None
+
+
+class HealthProber:
+    """
+    Checks the health of several components concurrently in the background and caches the outcome.
+
+    Health endpoints read :meth:`status` instead of contacting the components themselves, so frequent
+    probes by load balancers cost nothing and never block the event loop. A check that raises or does
+    not finish within ``timeout`` seconds marks its component as not ok.
+    """
+
+    def __init__(self, checks: Dict[str, Callable[[], Awaitable[Health]]], interval: float, timeout: float):
+        """
+        :param checks: Coroutine functions by component name. Wrap blocking checks with :meth:`blocking`.
+        :param interval: Seconds between two rounds of checks.
+        :param timeout: Seconds after which a single check counts as failed.
+        """
+        self.checks = checks
+        self.interval = interval
+        self.timeout = timeout
+        self._status: Dict[str, ComponentHealth] = {name: ComponentHealth(Health.NOT_OK) for name in checks}
+        self._task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def blocking(check: Callable[[], Health]) -> Callable[[], Awaitable[Health]]:
+        """Run a blocking health check in a worker thread."""
+
+        async def run() -> Health:
+            return await asyncio.to_thread(check)
+
+        return run
+
+    def status(self) -> Dict[str, ComponentHealth]:
+        return dict(self._status)
+
+    async def refresh(self) -> None:
+        """Run all checks concurrently and store their outcome."""
+        results = await asyncio.gather(*(self._check(name, check) for name, check in self.checks.items()))
+        self._status = dict(zip(self.checks, results))
+
+    async def _check(self, name: str, check: Callable[[], Awaitable[Health]]) -> ComponentHealth:
+        start = time.perf_counter()
+        try:
+            async with asyncio.timeout(self.timeout):
+                status = await check()
+        except TimeoutError:
+            log.error(f'Health check of {name} timed out after {self.timeout}s')
+            status = Health.NOT_OK
+        except Exception as exc:
+            log.error(f'Health check of {name} failed: {exc}')
+            status = Health.NOT_OK
+        latency_ms = (time.perf_counter() - start) * 1000
+        HEALTH_CHECK_SECONDS.labels(name).set(latency_ms / 1000)
+        COMPONENT_UP.labels(name).set(status == Health.OK)
+        return ComponentHealth(status, latency_ms, datetime.now(timezone.utc))
+
+    async def start(self) -> None:
+        """Check once, so the state is known before serving, then keep checking in the background."""
+        await self.refresh()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.refresh()
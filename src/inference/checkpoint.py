@@ -0,0 +1,104 @@
+import functools
+import hashlib
+import logging
+import os
+import time
+from typing import Dict
+
+import torch
+import torchvision.transforms as transforms
+from huggingface_hub import hf_hub_download
+from huggingface_hub.utils import LocalEntryNotFoundError
+from safetensors.torch import load_file, save_file
+
+from src.config import get_config
+from src.inference.model import SiameseNetwork
+from src.metrics.prometheus import MODEL_STARTUP_SECONDS
+
+log = logging.getLogger(__name__)
+
+transform = transforms.Compose(
+    [
+        transforms.Resize((224, 224)),
+        transforms.ToTensor(),
+        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+    ]
+)
+
+
+def model_version() -> str:
+    """
+    Identifier of the configured checkpoint, stored with every indexed embedding.
+
+    A local checkpoint is identified by its file name and a hash of its content, so embeddings of
+    different files at the same path get different versions.
+    """
+    model_cfg = get_config().inference.model
+    if model_cfg.path:
+        return _local_model_version(model_cfg.path, os.stat(model_cfg.path).st_mtime_ns)
+    return f'{model_cfg.repo_id}/{model_cfg.filename}'
+
+
+@functools.cache
+def _local_model_version(path: str, mtime_ns: int) -> str:
+    # Called for every indexed row, the file is only hashed again once it was modified
+    with open(path, 'rb') as file:
+        digest = hashlib.file_digest(file, 'sha256').hexdigest()
+    return f'{os.path.basename(path)}@{digest[:16]}'
+
+
+def load_model(device, warm_up: bool = True) -> SiameseNetwork:
+    """
+    Load the SiameseNetwork checkpoint for inference.
+
+    The checkpoint is looked up in this order: the configured ``path``, the safetensors cache in
+    ``cache_dir``, the local Hugging Face Hub cache and finally the Hub itself. A downloaded
+    checkpoint is written to the safetensors cache, so later starts memory map it and work offline.
+    The ImageNet weights of the backbone are never loaded, they are replaced by the checkpoint anyway.
+
+    :param device: Device to load the model on.
+    :param warm_up: Run one forward pass, so that the first request does not pay for lazy initialisation.
+    """
+    start = time.perf_counter()
+
+    model = SiameseNetwork(pretrained=False)
+    model.load_state_dict(_load_state_dict(device))
+    model.to(device).eval()
+
+    if warm_up:
+        with torch.inference_mode():
+            model.forward_one(torch.zeros(1, 3, 224, 224, device=device))
+
+    startup_seconds = time.perf_counter() - start
+    MODEL_STARTUP_SECONDS.labels('checkpoint').set(startup_seconds)
+    log.info(f'Model {model_version()} ready in {startup_seconds:.2f}s')
+    return model
+
+
+def _load_state_dict(device) -> Dict[str, torch.Tensor]:
+    model_cfg = get_config().inference.model
+    device = str(device)
+    if model_cfg.path:
+        return _read_checkpoint(model_cfg.path, device)
+
+    cache_file = os.path.join(model_cfg.cache_dir, f'{os.path.splitext(model_cfg.filename)[0]}.safetensors')
+    if os.path.exists(cache_file):
+        return load_file(cache_file, device=device)
+
+    try:
+        model_file = hf_hub_download(repo_id=model_cfg.repo_id, filename=model_cfg.filename, local_files_only=True)
+    except LocalEntryNotFoundError:
+        model_file = hf_hub_download(repo_id=model_cfg.repo_id, filename=model_cfg.filename)
+    state_dict = _read_checkpoint(model_file, device)
+
+    os.makedirs(model_cfg.cache_dir, exist_ok=True)
+    save_file({name: tensor.contiguous() for name, tensor in state_dict.items()}, cache_file)
+    log.info(f'Cached checkpoint as {cache_file}')
+    return state_dict
+
+
+def _read_checkpoint(path, device) -> Dict[str, torch.Tensor]:
+    if path.endswith('.safetensors'):
+        return load_file(path, device=device)
+    checkpoint = torch.load(path, map_location=device, mmap=True)
+    return checkpoint['model_state_dict']
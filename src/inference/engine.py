@@ -0,0 +1,107 @@
+import logging
+import os
+import time
+from abc import ABC, abstractmethod
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from src.inference.checkpoint import load_model
+
+log = logging.getLogger(__name__)
+
+BACKENDS = ('eager', 'compile', 'torchscript', 'onnx', 'onnx-int8', 'int8')
+
+# Files written by src.inference.export into the artifact directory
+ARTIFACTS = {
+    'torchscript': 'siamese_resnet18.ts',
+    'onnx': 'siamese_resnet18.onnx',
+    'onnx-int8': 'siamese_resnet18.int8.onnx',
+    'int8': 'siamese_resnet18.int8.ts',
+}
+
+
+class InferenceBackend(ABC):
+    """Computes (not normalized) embeddings, equivalent to :meth:`SiameseNetwork.forward_one`."""
+
+    @abstractmethod
+    def __call__(self, images: torch.Tensor) -> np.ndarray:
+        """
+        :param images: Preprocessed image batch of shape [N, 3, 224, 224].
+        :return: Embeddings of shape [N, 128].
+        """
+        pass
+
+
+class TorchBackend(InferenceBackend):
+    def __init__(self, module: nn.Module, device):
+        self.module = module
+        self.device = device
+
+    def __call__(self, images: torch.Tensor) -> np.ndarray:
+        with torch.inference_mode():
+            return self.module(images.to(self.device)).cpu().numpy()
+
+
+class OnnxBackend(InferenceBackend):
+    def __init__(self, model_path: str, num_threads: int = 0):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, images: torch.Tensor) -> np.ndarray:
+        return self.session.run(None, {self.input_name: images.numpy()})[0]
+
+
+def load_backend(
+    name: str, device, artifact_dir: str = 'models', num_threads: int = 0, warm_up: bool = True
+) -> InferenceBackend:
+    """
+    Create an inference backend.
+
+    ``eager`` and ``compile`` are built from the checkpoint, all other backends load the artifacts
+    exported by ``python -m src.inference.export``. Optimized backends only run on CPU.
+
+    :param name: One of :data:`BACKENDS`.
+    :param device: Device to run the eager and compiled model on.
+    :param artifact_dir: Directory with the exported artifacts.
+    :param num_threads: Intra-op threads, 0 keeps the runtime default.
+    :param warm_up: Run forward passes before returning, so the first requests do not pay for lazy
+        initialisation and (for TorchScript) the profiling runs of the JIT.
+    """
+    if name not in BACKENDS:
+        raise ValueError(f'Unknown inference backend "{name}", expected one of {BACKENDS}')
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    log.info(f'Loading "{name}" inference backend')
+
+    start = time.perf_counter()
+    backend = _create_backend(name, device, artifact_dir, num_threads)
+    if warm_up:
+        for _ in range(2):
+            backend(torch.zeros(1, 3, 224, 224))
+    log.info(f'"{name}" inference backend ready in {time.perf_counter() - start:.2f}s')
+    return backend
+
+
+def _create_backend(name: str, device, artifact_dir: str, num_threads: int) -> InferenceBackend:
+    if name == 'eager':
+        return TorchBackend(load_model(device, warm_up=False).base_model, device)
+    if name == 'compile':
+        return TorchBackend(torch.compile(load_model(device, warm_up=False).base_model), device)
+
+    artifact = os.path.join(artifact_dir, ARTIFACTS[name])
+    if not os.path.exists(artifact):
+        raise FileNotFoundError(f'{artifact} not found, export it with "python -m src.inference.export"')
+    if name in ('onnx', 'onnx-int8'):
+        return OnnxBackend(artifact, num_threads)
+    module = torch.jit.load(artifact, map_location='cpu')
+    if name == 'torchscript':
+        # Layout conversions and op fusions for the local CPU, these are not portable and not saved in the artifact
+        module = torch.jit.optimize_for_inference(module)
+    return TorchBackend(module, 'cpu')
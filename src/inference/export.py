@@ -0,0 +1,127 @@
+"""
+Export the SiameseNetwork checkpoint for the optimized inference backends and verify them against eager mode.
+
+Writes a frozen TorchScript model, an ONNX model, a dynamically int8 quantized ONNX model and a statically
+int8 quantized TorchScript model into the artifact directory. Every exported backend must reproduce the eager
+embeddings of the check images within a cosine similarity tolerance, otherwise the command fails.
+
+Example::
+
+    python -m src.inference.export --output-dir models --images images --limit 64
+"""
+
+import argparse
+import logging
+import os
+import sys
+
+import numpy as np
+import torch
+import torch.nn as nn
+from PIL import Image
+
+from src.inference.checkpoint import load_model, transform
+from src.inference.engine import ARTIFACTS, load_backend
+
+log = logging.getLogger(__name__)
+
+
+def load_images(folder, limit) -> torch.Tensor:
+    """Preprocess up to ``limit`` images of a folder, or random inputs if no folder is given."""
+    if folder is None:
+        log.warning('No image folder given, using random inputs for calibration and verification')
+        return torch.randn(limit, 3, 224, 224)
+    image_files = sorted(f for f in os.listdir(folder) if f.endswith(('.jpg', '.jpeg', '.png')))[:limit]
+    return torch.stack([transform(Image.open(os.path.join(folder, f)).convert('RGB')) for f in image_files])
+
+
+def export_torchscript(base_model: nn.Module, path):
+    traced = torch.jit.trace(base_model, torch.randn(1, 3, 224, 224))
+    torch.jit.save(torch.jit.freeze(traced.eval()), path)
+
+
+def export_onnx(base_model: nn.Module, path):
+    torch.onnx.export(
+        base_model,
+        torch.randn(1, 3, 224, 224),
+        path,
+        input_names=['images'],
+        output_names=['embeddings'],
+        dynamic_axes={'images': {0: 'batch'}, 'embeddings': {0: 'batch'}},
+        opset_version=17,
+    )
+
+
+def export_onnx_int8(onnx_path, path):
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantize_dynamic(onnx_path, path, weight_type=QuantType.QInt8)
+
+
+def export_int8(base_model: nn.Module, calibration_images: torch.Tensor, path, batch_size=16):
+    """Static post-training quantization of the fused ResNet18, calibrated on the given images."""
+    from torchvision.models.quantization import resnet18 as quantizable_resnet18
+
+    quantizable = quantizable_resnet18(weights=None, quantize=False)
+    quantizable.fc = nn.Linear(quantizable.fc.in_features, 128)
+    quantizable.load_state_dict(base_model.state_dict())
+    quantizable.eval()
+    quantizable.fuse_model()
+    quantizable.qconfig = torch.ao.quantization.get_default_qconfig('x86')
+    torch.ao.quantization.prepare(quantizable, inplace=True)
+    with torch.inference_mode():
+        for batch in calibration_images.split(batch_size):
+            quantizable(batch)
+    torch.ao.quantization.convert(quantizable, inplace=True)
+    torch.jit.save(torch.jit.trace(quantizable, calibration_images[:1]), path)
+
+
+def cosine_similarities(expected: np.ndarray, actual: np.ndarray) -> np.ndarray:
+    expected = expected / np.linalg.norm(expected, axis=1, keepdims=True)
+    actual = actual / np.linalg.norm(actual, axis=1, keepdims=True)
+    return (expected * actual).sum(axis=1)
+
+
+def verify(output_dir, images: torch.Tensor, tolerance, int8_tolerance) -> bool:
+    """Compare every exported backend with eager mode, return False if any is outside its tolerance."""
+    expected = load_backend('eager', 'cpu', warm_up=False)(images)
+    passed = True
+    for name in ARTIFACTS:
+        similarities = cosine_similarities(expected, load_backend(name, 'cpu', output_dir, warm_up=False)(images))
+        minimum = tolerance if 'int8' not in name else int8_tolerance
+        ok = bool(similarities.min() >= minimum)
+        passed &= ok
+        print(
+            f'{name:>12}: min cosine {similarities.min():.6f}, mean {similarities.mean():.6f} '
+            f'(tolerance {minimum}) {"OK" if ok else "FAILED"}'
+        )
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output-dir', default='models', help='artifact directory, see inference.engine config')
+    parser.add_argument('--images', default=None, help='folder of papyrus images for calibration and verification')
+    parser.add_argument('--limit', type=int, default=64, help='number of images used')
+    parser.add_argument('--tolerance', type=float, default=0.9999, help='minimum cosine similarity to eager mode')
+    parser.add_argument('--int8-tolerance', type=float, default=0.99, help='minimum cosine similarity for int8')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    base_model = load_model('cpu', warm_up=False).base_model
+    images = load_images(args.images, args.limit)
+    artifact = {name: os.path.join(args.output_dir, filename) for name, filename in ARTIFACTS.items()}
+
+    export_torchscript(base_model, artifact['torchscript'])
+    export_onnx(base_model, artifact['onnx'])
+    export_onnx_int8(artifact['onnx'], artifact['onnx-int8'])
+    export_int8(base_model, images, artifact['int8'])
+    log.info(f'Exported {", ".join(artifact.values())}')
+
+    if not verify(args.output_dir, images, args.tolerance, args.int8_tolerance):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
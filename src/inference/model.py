@@ -4,10 +4,11 @@ import torch.nn.functional as F
 
 
 class SiameseNetwork(nn.Module):
-    def __init__(self):
+    def __init__(self, pretrained=True):
         super(SiameseNetwork, self).__init__()
 
-        self.base_model = models.resnet18(pretrained=True)
+        # ImageNet weights are only useful for training, inference loads a checkpoint over them
+        self.base_model = models.resnet18(pretrained=pretrained)
 
         # Modify the fully connected layer to output a 128-dimensional embedding
         num_ftrs = self.base_model.fc.in_features
@@ -1,51 +1,61 @@
 from fastapi import UploadFile
 import litserve as ls
 import torch
-import torchvision.transforms as transforms
 from PIL import Image
-from src.inference.model import SiameseNetwork
-from huggingface_hub import hf_hub_download
+from src.config import get_config
+from src.inference.checkpoint import transform
+from src.inference.engine import load_backend
+from src.metrics.prometheus import BATCH_SIZE, MODEL_STARTUP_SECONDS, start_metrics_server, timed
 import logging
+import time
 
 log = logging.getLogger(__name__)
 
-transform = transforms.Compose(
-    [
-        transforms.Resize((224, 224)),
-        transforms.ToTensor(),
-        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-    ]
-)
-
 
 class SiameseLitAPI(ls.LitAPI):
     def setup(self, device):
-        model_file = hf_hub_download(repo_id='veerav96/papyrusNet', filename='resnet18_checkpoint_RUN10.pth')
-        checkpoint = torch.load(model_file, map_location=device)
-        model_state_dict = checkpoint['model_state_dict']
-        self.model = SiameseNetwork().to(device)
-        self.model.load_state_dict(model_state_dict)
-        self.model.eval()
+        cfg = get_config()
+        engine = cfg.inference.engine
+        # predict runs in a LitServe worker process, metrics are served from here
+        start_metrics_server(cfg.metrics.inference_port)
+        start = time.perf_counter()
+        # Includes the warm-up passes, LitServe reports healthy only once setup has returned
+        self.backend = load_backend(engine.backend, device, engine.artifact_dir, engine.num_threads)
+        MODEL_STARTUP_SECONDS.labels('backend').set(time.perf_counter() - start)
         self.device = device
 
     def decode_request(self, request: UploadFile):
-        image = Image.open(request.file).convert('RGB')
-        log.info('Image opened and converted to RGB: %s', image.size)
-        image = transform(image)
-        return image.unsqueeze(0)  # Add batch dimension
+        with timed('inference', 'decode'):
+            image = Image.open(request.file).convert('RGB')
+            log.debug('Image opened and converted to RGB: %s', image.size)
+            return transform(image)
+
+    def batch(self, inputs):
+        return torch.stack(inputs)  # [N, 3, 224, 224]
 
     def predict(self, image_tensor):
-        with torch.no_grad():
-            log.info('Input image tensor shape: %s', image_tensor.shape)
-            embedding = self.model.forward_one(image_tensor.to(self.device))
-            embedding = embedding.squeeze(0).cpu().numpy()
-        return {'embedding': embedding.tolist()}
+        batched = image_tensor.dim() == 4
+        if not batched:
+            image_tensor = image_tensor.unsqueeze(0)  # Add batch dimension
+        BATCH_SIZE.labels('inference').observe(image_tensor.shape[0])
+        with timed('inference', 'forward'):
+            embeddings = self.backend(image_tensor)
+        return embeddings if batched else embeddings[0]
+
+    def unbatch(self, output):
+        return list(output)
 
     def encode_response(self, output):
-        return output
+        return {'embedding': output.tolist()}
 
 
 if __name__ == '__main__':
+    cfg = get_config()
     api = SiameseLitAPI()
-    server = ls.LitServer(api, accelerator='auto')
-    server.run(port=8001)
+    server = ls.LitServer(
+        api,
+        accelerator='auto',
+        max_batch_size=cfg.inference.server.max_batch_size,
+        batch_timeout=cfg.inference.server.batch_timeout,
+    )
+    server.run(port=cfg.inference.server.port)
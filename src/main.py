@@ -1,3 +1,5 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
 from pathlib import Path
 from fastapi.responses import HTMLResponse
@@ -5,33 +7,53 @@ from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi import FastAPI, Request
 from fastapi.openapi.docs import get_swagger_ui_html
+import httpx
+import redis.asyncio as redis
 import uvicorn
 import yaml
 import os
 import logging
-from hydra import compose
+from src.config import get_config
 from src.database.postgres import Postgres
 from src.storage.minio import MinioClient
 from src.api import papyrus_retrieval, health
+from src.metrics.prometheus import QueueDepthCollector, metrics_app
 
 config_dir = os.getenv('PAPYRUS_APP_CONFIG_DIR', str(Path(__file__).resolve().parent.parent / 'config'))
 log_level = os.getenv('LOG_LEVEL', 'INFO')
 log_config = f'{config_dir}/logging/logging.yaml'
 log = logging.getLogger(__name__)
 
+cfg = get_config()
+
 
 @asynccontextmanager
 async def configure_dependencies(app: FastAPI):
     log.info('Initialising...')
 
-    cfg = compose(config_name='config')
-
     app.state.minio_client = MinioClient.from_config(cfg)
     app.state.database = Postgres.from_config(cfg)
+    # Shared keep-alive connection pool to the inference server for synchronous searches
+    app.state.inference_client = httpx.AsyncClient(base_url=cfg.inference.url, timeout=cfg.api.search.timeout)
+    app.state.search_slots = asyncio.Semaphore(cfg.api.search.max_concurrency)
+    # Decoding, warping and uploading query images blocks, it runs here instead of on the event loop
+    app.state.preprocess_pool = ThreadPoolExecutor(
+        max_workers=cfg.api.preprocess.workers, thread_name_prefix='preprocess'
+    )
+    app.state.preprocess_slots = asyncio.Semaphore(cfg.api.preprocess.workers + cfg.api.preprocess.queue_size)
+    # Workers announce finished tasks on the result backend, see /papyrus/result/{task_id}/events
+    app.state.result_events = redis.Redis.from_url(cfg.worker.backend_url)
+    app.state.health_prober = health.create_health_prober(app.state, cfg.api.health.interval, cfg.api.health.timeout)
+    await app.state.health_prober.start()
 
     log.info('Initialisation completed')
     yield
 
+    await app.state.health_prober.stop()
+    await app.state.inference_client.aclose()
+    app.state.preprocess_pool.shutdown(wait=True)
+    await app.state.result_events.aclose()
+
 
 description = """
 Image search to fetch information about a given papyrus.
@@ -41,6 +63,7 @@ api = FastAPI(title='Papyrus Retrieval', description=description, lifespan=confi
 
 api.include_router(health.router)
 api.include_router(papyrus_retrieval.router)
+api.mount('/metrics', metrics_app([QueueDepthCollector(cfg.worker.broker_url, cfg.metrics.queues)]))
 api.mount('/static', StaticFiles(directory=Path(__file__).resolve().parent / 'ui' / 'static'), name='static')
 templates = Jinja2Templates(directory=Path(__file__).resolve().parent / 'ui' / 'templates')
 
@@ -0,0 +1,136 @@
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import Iterable, List
+
+from prometheus_client import (
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    make_asgi_app,
+    multiprocess,
+    start_http_server,
+)
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.registry import Collector
+from redis import Redis
+from redis.exceptions import RedisError
+
+log = logging.getLogger(__name__)
+
+# Query stages take from a millisecond (cache, search) to seconds (large uploads, cold inference)
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+STAGE_SECONDS = Histogram(
+    'papyrus_stage_seconds',
+    'Duration of a stage of the retrieval pipeline',
+    ['component', 'stage'],
+    buckets=STAGE_BUCKETS,
+)
+BATCH_SIZE = Histogram(
+    'papyrus_batch_size',
+    'Number of items processed together',
+    ['component'],
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256),
+)
+CACHE_REQUESTS = Counter(
+    'papyrus_cache_requests_total',
+    'Cache lookups by outcome, the hit rate is hit / (hit + miss)',
+    ['cache', 'outcome'],
+)
+MODEL_STARTUP_SECONDS = Gauge(
+    'papyrus_model_startup_seconds',
+    'Seconds until the model was ready, stage checkpoint covers loading it, stage backend the whole setup',
+    ['stage'],
+    multiprocess_mode='max',
+)
+
+HEALTH_CHECK_SECONDS = Gauge(
+    'papyrus_health_check_seconds',
+    'Duration of the last health check of a component',
+    ['component'],
+    multiprocess_mode='max',
+)
+COMPONENT_UP = Gauge(
+    'papyrus_component_up',
+    'Whether the last health check of a component succeeded',
+    ['component'],
+    multiprocess_mode='min',
+)
+
+
+@contextmanager
+def timed(component: str, stage: str):
+    """Observe the duration of the block in :data:`STAGE_SECONDS`, also if it raises."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(component, stage).observe(time.perf_counter() - start)
+
+
+class QueueDepthCollector(Collector):
+    """Reports the length of Celery queues on a Redis broker at scrape time."""
+
+    def __init__(self, broker_url: str, queues: Iterable[str]):
+        self.client = Redis.from_url(broker_url, socket_timeout=1)
+        self.queues = list(queues)
+
+    def describe(self):
+        # Lets the registry check for name clashes without querying the broker
+        yield self._gauge()
+
+    def collect(self):
+        gauge = self._gauge()
+        try:
+            pipeline = self.client.pipeline()
+            for queue in self.queues:
+                pipeline.llen(queue)
+            for queue, depth in zip(self.queues, pipeline.execute()):
+                gauge.add_metric([queue], depth)
+        except RedisError as exc:
+            log.warning(f'Failed to read the queue depth: {exc}')
+        yield gauge
+
+    @staticmethod
+    def _gauge() -> GaugeMetricFamily:
+        return GaugeMetricFamily('papyrus_queue_depth', 'Tasks waiting in a Celery queue', labels=['queue'])
+
+
+def metrics_registry(collectors: List[Collector] = ()) -> CollectorRegistry:
+    """
+    Registry to expose, aggregating all processes if ``PROMETHEUS_MULTIPROC_DIR`` is set.
+
+    :param collectors: Additional collectors evaluated at scrape time by the exposing process.
+    """
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    for collector in collectors:
+        registry.register(collector)
+    return registry
+
+
+def metrics_app(collectors: List[Collector] = ()):
+    """ASGI app serving the metrics in the Prometheus text format, to be mounted at ``/metrics``."""
+    return make_asgi_app(registry=metrics_registry(collectors))
+
+
+def start_metrics_server(port: int, collectors: List[Collector] = ()) -> bool:
+    """
+    Serve the metrics on their own port, for processes without a web server of their own.
+
+    :return: False if the port is taken, e.g. by another process of the same service.
+    """
+    try:
+        start_http_server(port, registry=metrics_registry(collectors))
+    except OSError as exc:
+        log.warning(f'Metrics are not served on port {port}: {exc}')
+        return False
+    log.info(f'Serving metrics on port {port}')
+    return True
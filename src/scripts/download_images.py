@@ -1,6 +1,12 @@
+import argparse
+import asyncio
 import os
-import requests
 import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+
+import httpx
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
 
 
 def find_graphic_url_in_xml(xml_file):
@@ -17,52 +23,125 @@ def find_graphic_url_in_xml(xml_file):
     return graphic_urls
 
 
-def download_image(url, save_path, xml_filename, log_file, success_count, failure_count):
-    response = requests.get(url)
-    if response.status_code == 200:
-        with open(save_path, 'wb') as file:
-            file.write(response.content)
-        log_file.write(f'Downloaded {save_path}\n')
-        success_count += 1
-    else:
-        log_file.write(f'Failed to download {url} for file {xml_filename}\n')
-        failure_count += 1
-    return success_count, failure_count
+def collect_download_jobs(xml_folder, image_save_folder, workers=None):
+    """
+    Parse all EpiDoc XML files in parallel and list the images to download.
 
+    :return: List of (image url, save path, xml filename) tuples.
+    """
+    xml_files = [
+        (root_dir, filename)
+        for root_dir, _, files in os.walk(xml_folder)
+        for filename in files
+        if filename.endswith('.xml')
+    ]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        paths = [os.path.join(root_dir, filename) for root_dir, filename in xml_files]
+        all_graphic_urls = executor.map(find_graphic_url_in_xml, paths, chunksize=64)
 
-def process_xml_files(xml_folder, image_save_folder, log_file_path):
-    success_count = 0
-    failure_count = 0
-    with open(log_file_path, 'w') as log_file:
-        for root_dir, _, files in os.walk(xml_folder):
-            for filename in files:
-                if filename.endswith('.xml'):
-                    xml_file_path = os.path.join(root_dir, filename)
-                    graphic_urls = find_graphic_url_in_xml(xml_file_path)
+        jobs = []
+        for (root_dir, filename), graphic_urls in zip(xml_files, all_graphic_urls):
+            relative_dir = os.path.relpath(root_dir, xml_folder)
+            save_dir = os.path.join(image_save_folder, relative_dir)
+            os.makedirs(save_dir, exist_ok=True)
+
+            base_filename = os.path.splitext(filename)[0]
+
+            for url in graphic_urls:
+                url_parts = url.split('/')
+                image_name = url_parts[-1]
+                image_url = f'{url}/0001/_image'
+                save_path = os.path.join(save_dir, f'{base_filename}_{image_name}.jpg')
+                jobs.append((image_url, save_path, filename))
+    return jobs
+
+
+async def download_image(client: httpx.AsyncClient, url, save_path, retries=3, backoff=1.0):
+    """
+    Stream an image to disk, retrying transient failures with exponential backoff.
+
+    The image is written to a temporary file first, so an interrupted download is never
+    mistaken for a complete one.
 
-                    relative_dir = os.path.relpath(root_dir, xml_folder)
-                    save_dir = os.path.join(image_save_folder, relative_dir)
+    :return: True if the image was downloaded.
+    """
+    partial_path = f'{save_path}.part'
+    try:
+        for attempt in range(retries + 1):
+            try:
+                async with client.stream('GET', url) as response:
+                    if response.status_code == 200:
+                        with open(partial_path, 'wb') as file:
+                            async for chunk in response.aiter_bytes():
+                                file.write(chunk)
+                        os.replace(partial_path, save_path)
+                        return True
+                    if response.status_code not in RETRY_STATUS_CODES:
+                        return False
+            except httpx.TransportError:
+                pass
+            if attempt < retries:
+                await asyncio.sleep(backoff * 2**attempt)
+        return False
+    finally:
+        # Drop the partial file of a failed or cancelled download
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
 
-                    if not os.path.exists(save_dir):
-                        os.makedirs(save_dir)
 
-                    base_filename = os.path.splitext(filename)[0]
+async def download_images(jobs, client: httpx.AsyncClient, log_file, concurrency=16, retries=3, backoff=1.0):
+    """
+    Download all images with at most ``concurrency`` requests in flight, skipping existing files.
 
-                    for url in graphic_urls:
-                        url_parts = url.split('/')
-                        image_name = url_parts[-1]
-                        image_url = f'{url}/0001/_image'
-                        save_path = os.path.join(save_dir, f'{base_filename}_{image_name}.jpg')
-                        success_count, failure_count = download_image(
-                            image_url, save_path, filename, log_file, success_count, failure_count
-                        )
+    :return: Tuple of successful, failed and skipped download counts.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    counts = {'success': 0, 'failure': 0, 'skipped': 0}
+
+    async def download(url, save_path, xml_filename):
+        if os.path.exists(save_path):
+            counts['skipped'] += 1
+            return
+        async with semaphore:
+            downloaded = await download_image(client, url, save_path, retries, backoff)
+        if downloaded:
+            log_file.write(f'Downloaded {save_path}\n')
+            counts['success'] += 1
+        else:
+            log_file.write(f'Failed to download {url} for file {xml_filename}\n')
+            counts['failure'] += 1
+
+    await asyncio.gather(*(download(*job) for job in jobs))
+    return counts['success'], counts['failure'], counts['skipped']
+
+
+async def process_xml_files_async(xml_folder, image_save_folder, log_file_path, concurrency=16, retries=3, timeout=60):
+    jobs = collect_download_jobs(xml_folder, image_save_folder)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    with open(log_file_path, 'w') as log_file:
+        async with httpx.AsyncClient(limits=limits, timeout=timeout, follow_redirects=True) as client:
+            success_count, failure_count, skipped_count = await download_images(
+                jobs, client, log_file, concurrency=concurrency, retries=retries
+            )
 
         log_file.write(f'\nTotal successful downloads: {success_count}\n')
         log_file.write(f'Total failed downloads: {failure_count}\n')
+        log_file.write(f'Total skipped (already downloaded): {skipped_count}\n')
+
+
+def process_xml_files(xml_folder, image_save_folder, log_file_path, concurrency=16, retries=3, timeout=60):
+    asyncio.run(process_xml_files_async(xml_folder, image_save_folder, log_file_path, concurrency, retries, timeout))
 
 
 if __name__ == '__main__':
-    xml_folder = 'data-master/HGV_meta_EpiDoc'
-    image_save_folder = 'images'
-    log_file_path = 'download_images.log'  # Path to the log file
-    process_xml_files(xml_folder, image_save_folder, log_file_path)
+    parser = argparse.ArgumentParser(description='Download the papyrus images referenced by HGV EpiDoc XML files')
+    parser.add_argument('--xml-folder', default='data-master/HGV_meta_EpiDoc')
+    parser.add_argument('--image-save-folder', default='images')
+    parser.add_argument('--log-file', default='download_images.log', help='Path to the log file')
+    parser.add_argument('--concurrency', type=int, default=16, help='Maximum number of parallel downloads')
+    parser.add_argument('--retries', type=int, default=3, help='Retries per image on transient failures')
+    parser.add_argument('--timeout', type=float, default=60, help='HTTP timeout per request in seconds')
+    args = parser.parse_args()
+    process_xml_files(
+        args.xml_folder, args.image_save_folder, args.log_file, args.concurrency, args.retries, args.timeout
+    )
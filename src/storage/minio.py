@@ -1,5 +1,7 @@
-from minio import Minio
-from minio.error import MinioException, S3Error
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+from typing import Optional, Tuple
+
 from omegaconf import DictConfig
 from src.health.health import HealthMixin, Health
 import logging
@@ -8,11 +10,17 @@ log = logging.getLogger(__name__)
 
 
 class MinioClient(HealthMixin):
+    """Wrapper of the MinIO SDK, which is imported once a client is created rather than with this module."""
+
     def __init__(self, endpoint, access_key, secret_key, secure=True):
+        from minio import Minio
+
         self.client = Minio(endpoint, access_key=access_key, secret_key=secret_key, secure=secure)
 
     def ensure_bucket(self, bucket_name: str):
         """Ensure a single bucket exists, and create it if not present."""
+        from minio.error import S3Error
+
         try:
             if not self.client.bucket_exists(bucket_name):
                 self.client.make_bucket(bucket_name)
@@ -27,8 +35,54 @@ class MinioClient(HealthMixin):
         for bucket_name in bucket_list:
             self.ensure_bucket(bucket_name)
 
+    def remove_expired_objects(
+        self, bucket_name: str, max_age: timedelta, limit: int, max_listed: int, start_after: Optional[str] = None
+    ) -> Tuple[int, Optional[str]]:
+        """
+        Delete objects last modified more than ``max_age`` ago with a single multi-object delete request.
+
+        At most ``max_listed`` objects are listed, in key order after ``start_after``, and listing stops as
+        soon as ``limit`` expired objects are found. One call therefore does bounded work however large
+        the bucket is, and passing the returned cursor to the next call walks the whole bucket over
+        several calls.
+
+        :param bucket_name: The bucket to clean up.
+        :param max_age: Age after which an object expires.
+        :param limit: Maximum number of objects deleted.
+        :param max_listed: Maximum number of objects listed.
+        :param start_after: Key to continue listing after, None to start at the beginning of the bucket.
+        :return: Number of objects deleted, and the key to continue after or None once the end of the
+            bucket was reached.
+        """
+        from minio.deleteobjects import DeleteObject
+
+        expired_before = datetime.now(timezone.utc) - max_age
+        # The listing is fetched page by page as it is iterated
+        objects = islice(self.client.list_objects(bucket_name, start_after=start_after), max_listed)
+        to_delete = []
+        listed = 0
+        cursor = None
+        for obj in objects:
+            listed += 1
+            cursor = obj.object_name
+            if obj.last_modified < expired_before:
+                to_delete.append(DeleteObject(obj.object_name))
+                if len(to_delete) == limit:
+                    break
+        if len(to_delete) < limit and listed < max_listed:
+            cursor = None  # end of the bucket, start over next time
+        if not to_delete:
+            return 0, cursor
+        # The deletion is lazy, it runs while the returned errors are iterated
+        errors = list(self.client.remove_objects(bucket_name, to_delete))
+        for error in errors:
+            log.error(f'Failed to delete {error.name} from {bucket_name}: {error.message}')
+        return len(to_delete) - len(errors), cursor
+
     def health(self) -> Health:
         """perform a health check."""
+        from minio.error import MinioException
+
         try:
             self.client.list_buckets()
             return Health.OK
@@ -1,41 +1,24 @@
+import hashlib
 import logging
-from hydra import compose
+import time
+from concurrent.futures import ThreadPoolExecutor
 import os
-import torch
-import torchvision.transforms as transforms
 from PIL import Image
-from huggingface_hub import hf_hub_download
-from src.inference.model import SiameseNetwork
+from src.cache.redis import RedisCache
+from src.config import get_config
 from src.database.repository import PapyrusEmbeddingEntity
 from src.database.postgres import Postgres
 import uuid
-from datetime import datetime
 
-cfg = compose(config_name='config')
+# torch and the model are imported by the functions that embed images, the file helpers do not need them
 
 log = logging.getLogger(__name__)
 
 
-transform = transforms.Compose(
-    [
-        transforms.Resize((224, 224)),
-        transforms.ToTensor(),
-        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-    ]
-)
-
-
-def load_model(device):
-    model_file = hf_hub_download(repo_id='veerav96/papyrusNet', filename='resnet18_checkpoint_RUN10.pth')
-    checkpoint = torch.load(model_file, map_location=device)
-    model_state_dict = checkpoint['model_state_dict']
-    model = SiameseNetwork().to(device)
-    model.load_state_dict(model_state_dict)
-    model.eval()
-    return model
-
-
 def compute_embedding(model, image_path, device):
+    import torch
+    from src.inference.checkpoint import transform
+
     image = Image.open(image_path).convert('RGB')
     image_tensor = transform(image).unsqueeze(0)  # Add batch dimension
     with torch.no_grad():
@@ -57,40 +40,165 @@ def get_url_from_filename(filename: str) -> str:
     return url
 
 
-def process_images_bulk_insert(model, folder_path, device, batch_size=30):
-    database = Postgres.from_config(cfg)
-    entities = []
+class AnchorImageDataset:
+    """Map-style dataset of the decoded and resized reference images of a folder, paired with their filenames."""
+
+    extensions = ('.jpg', '.jpeg', '.png')
+
+    def __init__(self, folder_path, image_files=None):
+        self.folder_path = folder_path
+        if image_files is None:
+            image_files = list_image_files(folder_path)
+        self.image_files = image_files
+
+    def __len__(self):
+        return len(self.image_files)
+
+    def __getitem__(self, index):
+        from src.inference.checkpoint import transform
+
+        image_file = self.image_files[index]
+        image = Image.open(os.path.join(self.folder_path, image_file)).convert('RGB')
+        return transform(image), image_file
+
+
+def list_image_files(folder_path):
+    return sorted(entry.name for entry in os.scandir(folder_path) if entry.name.endswith(AnchorImageDataset.extensions))
+
+
+def file_digest(path) -> str:
+    with open(path, 'rb') as file:
+        return hashlib.file_digest(file, 'sha256').hexdigest()
+
+
+def find_pending_images(database, folder_path, num_workers=4):
+    """
+    Select the images of a folder that are not indexed yet, or changed since they were indexed.
+
+    :return: Mapping of pending filename to content hash.
+    """
+    from src.inference.checkpoint import model_version
+
+    image_files = {}
+    for image_file in list_image_files(folder_path):
+        # Several files can map to the same url, only the first one is indexed
+        image_files.setdefault(get_url_from_filename(image_file), image_file)
+
+    with ThreadPoolExecutor(max_workers=max(num_workers, 1)) as executor:
+        paths = [os.path.join(folder_path, image_file) for image_file in image_files.values()]
+        digests = dict(zip(image_files.values(), executor.map(file_digest, paths)))
+
+    indexed = database.papyrus_embedding_repository.get_content_hashes(model_version())
+    pending = {
+        image_file: digests[image_file]
+        for url, image_file in image_files.items()
+        if indexed.get(url) != digests[image_file]
+    }
+    log.info(f'{len(pending)} of {len(image_files)} images are new or changed')
+    return pending
+
+
+def process_images_bulk_insert(model, folder_path, device, batch_size=64, num_workers=4, insert_batch_size=1024):
+    """
+    Embed the new and changed reference images of a folder and upsert them into the database.
 
-    for image_file in os.listdir(folder_path):
-        image_path = os.path.join(folder_path, image_file)
+    Images are decoded and resized by ``num_workers`` DataLoader processes while the model embeds
+    the previous batch, and rows are written with COPY in chunks of ``insert_batch_size``. Every chunk
+    is committed, so an interrupted run resumes with the images that were not written yet.
+    """
+    import torch
+    from torch.utils.data import DataLoader
 
-        if image_file.endswith(('.jpg', '.jpeg', '.png')):  # Filter by image files
-            embedding = compute_embedding(model, image_path, device)
-            url = get_url_from_filename(image_file)
+    from src.inference.checkpoint import model_version
 
-            entity = PapyrusEmbeddingEntity(
-                id=uuid.uuid4(),
-                url=url,
-                created_at=datetime.now(),
-                modified_at=datetime.now(),
-                embedding=embedding.tolist(),
+    cfg = get_config()
+    database = Postgres.from_config(cfg)
+    # Cached search results predate the upserted rows, cached query embeddings possibly the model
+    cache = RedisCache.from_config(cfg) if cfg.cache.enabled else None
+    pending = find_pending_images(database, folder_path, num_workers)
+    dataset = AnchorImageDataset(folder_path, list(pending))
+    loader = DataLoader(
+        dataset,
+        batch_size=batch_size,
+        num_workers=num_workers,
+        pin_memory=device.type == 'cuda',
+    )
+    log.info(f'Indexing {len(dataset)} images from {folder_path}')
+
+    stage_seconds = {'decode': 0.0, 'embed': 0.0, 'insert': 0.0}
+    entities = []
+    processed = 0
+    start = time.perf_counter()
+
+    batches = iter(loader)
+    while True:
+        stage_start = time.perf_counter()
+        batch = next(batches, None)
+        stage_seconds['decode'] += time.perf_counter() - stage_start
+        if batch is None:
+            break
+        image_tensors, image_files = batch
+
+        stage_start = time.perf_counter()
+        with torch.no_grad():
+            embeddings = model.forward_one(image_tensors.to(device, non_blocking=True)).cpu().numpy()
+        stage_seconds['embed'] += time.perf_counter() - stage_start
+        processed += len(image_files)
+
+        for image_file, embedding in zip(image_files, embeddings):
+            entities.append(
+                PapyrusEmbeddingEntity(
+                    id=uuid.uuid4(),
+                    url=get_url_from_filename(image_file),
+                    content_hash=pending[image_file],
+                    model_version=model_version(),
+                    embedding=embedding,
+                )
             )
-            entities.append(entity)
 
-            if len(entities) >= batch_size:
-                database.papyrus_embedding_repository.bulk_insert(entities)
-                entities.clear()
+        if len(entities) >= insert_batch_size:
+            stage_seconds['insert'] += _insert(database, cache, entities)
+            _report_throughput(processed, stage_seconds, start)
 
     if entities:
-        database.papyrus_embedding_repository.bulk_insert(entities)
+        stage_seconds['insert'] += _insert(database, cache, entities)
+    _report_throughput(processed, stage_seconds, start)
+
+
+def _insert(database, cache, entities) -> float:
+    stage_start = time.perf_counter()
+    database.papyrus_embedding_repository.copy_upsert(entities)
+    entities.clear()
+    if cache:
+        cache.clear('embedding')
+        cache.clear('search')
+    return time.perf_counter() - stage_start
+
+
+def _report_throughput(processed, stage_seconds, start):
+    """Log images per second of every stage; decode only counts time the forward passes had to wait."""
+    stages = ', '.join(f'{stage} {processed / seconds:.1f}' for stage, seconds in stage_seconds.items() if seconds)
+    log.info(f'{processed} images, {processed / (time.perf_counter() - start):.1f} images/s overall ({stages})')
 
 
 def main():
+    import torch
+
+    from src.inference.checkpoint import load_model
+
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     model = load_model(device)
-    folder_path = 'PATH-TO-ANCHOR-IMAGES'
-    process_images_bulk_insert(model, folder_path, device, batch_size=30)
+    ingestion = get_config().worker.ingestion
+    process_images_bulk_insert(
+        model,
+        ingestion.folder,
+        device,
+        batch_size=ingestion.batch_size,
+        num_workers=ingestion.num_workers,
+        insert_batch_size=ingestion.insert_batch_size,
+    )
 
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
     main()
@@ -1,15 +1,27 @@
-import io
+import hashlib
+import json
 import logging
-from hydra import compose
-from celery import Celery
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import timedelta
+from typing import Dict, List, Optional
+from celery import Celery, states
 from celery import chain
+from celery.result import AsyncResult
+from celery.signals import before_task_publish, task_postrun, task_prerun, worker_init, worker_process_init
+from redis import Redis
+from redis.exceptions import RedisError
+from src.cache.redis import RedisCache
+from src.config import get_config
 from src.storage.minio import MinioClient
 from src.database.postgres import Postgres
-from PIL import Image
+from src.metrics.prometheus import BATCH_SIZE, STAGE_SECONDS, start_metrics_server, timed
 import requests
 
 
-cfg = compose(config_name='config')
+cfg = get_config()
 
 log = logging.getLogger(__name__)
 
@@ -18,14 +30,209 @@ celery = Celery(
     broker=cfg.worker.broker_url,
     backend=cfg.worker.backend_url,
 )
+celery.conf.beat_schedule = {
+    'sync-storage': {
+        'task': f'{__name__}.sync_storage_task',
+        'schedule': cfg.worker.periodic.sync_storage.interval,
+    },
+}
 
+# Clients shared by all tasks of a worker process, see init_worker_process
+_database: Optional[Postgres] = None
+_minio_client: Optional[MinioClient] = None
+_cache: Optional[RedisCache] = None
+_publisher: Optional[Redis] = None
 
-def papyrus_retrieval(image_name):
-    workflow = chain(compute_embedding_task.s(image_name) | retrieve_similar_papyrus_task.s())
+RESULT_CHANNEL_PREFIX = 'papyrus:results:'
+# Key after which the next sync_storage_task run continues listing the query bucket
+SYNC_STORAGE_CURSOR = 'papyrus:sync_storage:cursor'
+
+
+@worker_process_init.connect
+def init_worker_process(**kwargs):
+    """
+    Create the database and storage clients once per worker process.
+
+    The signal fires in every prefork child after the fork, so connection pools are never shared
+    across processes. Schema verification and bucket checks therefore run once per process
+    instead of once per task.
+    """
+    get_database()
+    get_minio_client()
+    get_cache()
+
+
+@worker_init.connect
+def serve_worker_metrics(**kwargs):
+    """Serve the metrics of the worker from its main process, see config/metrics for prefork workers."""
+    start_metrics_server(cfg.metrics.worker_port)
+
+
+@before_task_publish.connect
+def stamp_task_publish_time(headers=None, **kwargs):
+    # Custom message headers become attributes of the task request on the worker
+    headers['published_at'] = time.time()
+
+
+@task_prerun.connect
+def observe_queue_wait(task=None, **kwargs):
+    """Time from publishing a task to a worker starting it, i.e. broker queueing and prefetch."""
+    published_at = getattr(task.request, 'published_at', None)
+    if published_at is not None:
+        STAGE_SECONDS.labels('worker', 'queue_wait').observe(max(0.0, time.time() - published_at))
+    task.request.started_at = time.perf_counter()
+
+
+@task_postrun.connect
+def observe_task_duration(task=None, **kwargs):
+    started_at = getattr(task.request, 'started_at', None)
+    if started_at is not None:
+        STAGE_SECONDS.labels('worker', task.name.rsplit('.', 1)[-1]).observe(time.perf_counter() - started_at)
+
+
+def get_database() -> Postgres:
+    global _database
+    if _database is None:
+        _database = Postgres.from_config(cfg)
+    return _database
+
+
+def get_minio_client() -> MinioClient:
+    global _minio_client
+    if _minio_client is None:
+        _minio_client = MinioClient.from_config(cfg)
+    return _minio_client
+
+
+def get_cache() -> Optional[RedisCache]:
+    global _cache
+    if _cache is None and cfg.cache.enabled:
+        _cache = RedisCache.from_config(cfg)
+    return _cache
+
+
+def get_publisher() -> Redis:
+    global _publisher
+    if _publisher is None:
+        _publisher = Redis.from_url(cfg.worker.backend_url)
+    return _publisher
+
+
+def result_channel(task_id: str) -> str:
+    """Redis pub/sub channel announcing that the result of a task is ready."""
+    return f'{RESULT_CHANNEL_PREFIX}{task_id}'
+
+
+@task_postrun.connect
+def publish_task_completion(task_id=None, task=None, state=None, **kwargs):
+    """
+    Announce finished tasks on their result channel, so the API can push results instead of being polled.
+
+    Only the state is published, the result itself is read from the result backend. When a chained task
+    fails, the remaining tasks of the chain are failed by Celery without running, so they are announced too.
+    """
+    if state not in states.READY_STATES:
+        return
+    task_ids = [task_id]
+    if state == states.FAILURE:
+        task_ids += [signature['options'].get('task_id') for signature in task.request.chain or []]
+    try:
+        publisher = get_publisher()
+        for ready_task_id in filter(None, task_ids):
+            publisher.publish(result_channel(ready_task_id), state)
+    except RedisError as exc:
+        log.warning(f'Failed to announce completion of task {task_id}: {exc}')
+
+
+def papyrus_retrieval(image_name, k: int = 1, min_similarity: Optional[float] = None):
+    """
+    Schedule the retrieval of a stored query image.
+
+    Query images are named by a hash of their content, so a resubmitted image is answered from the
+    embedding and search caches without running any task.
+
+    :param k: Number of matches to retrieve at most.
+    :param min_similarity: Drop matches below this cosine similarity.
+    """
+    cache = get_cache()
+    embedding = cache.get('embedding', image_name) if cache else None
+    if embedding is not None:
+        matches = cache.get('search', _search_key(embedding, k, min_similarity))
+        if matches is not None:
+            return _completed_result(matches)
+        return retrieve_similar_papyrus_task.delay(embedding, k=k, min_similarity=min_similarity)
+
+    if cfg.worker.workflow == 'fused':
+        return papyrus_retrieval_task.delay(image_name, k=k, min_similarity=min_similarity)
+    workflow = chain(
+        compute_embedding_task.s(image_name) | retrieve_similar_papyrus_task.s(k=k, min_similarity=min_similarity)
+    )
     result = workflow()
     return result
 
 
+@celery.task
+def papyrus_retrieval_task(image_name, k=1, min_similarity=None):
+    """
+    Run download, embedding and search in one task.
+
+    Unlike the chained workflow, the embedding never leaves the worker process, saving a result
+    backend write and a broker round trip.
+
+    :return: dict with the retrieved ``urls``, their similarity ``scores`` and per-stage ``timings`` in
+        milliseconds.
+    """
+    timings: Dict[str, float] = {}
+    with _timed(timings, 'total'):
+        with _timed(timings, 'download'):
+            image_data = download_image_from_minio(image_name)
+        with _timed(timings, 'embedding'):
+            embedding = send_image_to_litserve(image_data).get('embedding')
+            _cache_value('embedding', image_name, embedding)
+        with _timed(timings, 'search'):
+            matches = retrieve_similar_papyrus(embedding, k, min_similarity)
+    log.info(f'Retrieval of {image_name} finished, timings in ms: {timings}')
+    return {**matches, 'timings': timings}
+
+
+def papyrus_batch_retrieval(image_names: List[str], k: int = 1, min_similarity: Optional[float] = None) -> AsyncResult:
+    """
+    Schedule the retrieval of several stored query images as a single task.
+
+    :param k: Number of matches to retrieve at most per image.
+    :param min_similarity: Drop matches below this cosine similarity.
+    """
+    return papyrus_batch_retrieval_task.delay(image_names, k=k, min_similarity=min_similarity)
+
+
+@celery.task
+def papyrus_batch_retrieval_task(image_names, k=1, min_similarity=None):
+    """
+    Retrieve the matches of several query images.
+
+    The images are sent to the inference server concurrently, so its dynamic batching embeds them
+    in as few forward passes as its ``max_batch_size`` allows, and the candidates of all images are
+    fetched by a single database query before they are re-ranked like in :func:`retrieve_similar_papyrus`.
+
+    :return: List of dicts with the ``image`` name, its matched ``urls`` and their ``scores``, in the
+        submitted order.
+    """
+    BATCH_SIZE.labels('batch_retrieval').observe(len(image_names))
+    timings: Dict[str, float] = {}
+    with _timed(timings, 'total'):
+        with ThreadPoolExecutor(max_workers=max(1, min(len(image_names), cfg.inference.server.max_batch_size))) as pool:
+            with _timed(timings, 'download'):
+                images = list(pool.map(download_image_from_minio, image_names))
+            with _timed(timings, 'embedding'):
+                embeddings = [response.get('embedding') for response in pool.map(send_image_to_litserve, images)]
+        for image_name, embedding in zip(image_names, embeddings):
+            _cache_value('embedding', image_name, embedding)
+        with _timed(timings, 'search'):
+            results = retrieve_similar_papyrus_batch(embeddings, k, min_similarity)
+    log.info(f'Batch retrieval of {len(image_names)} images finished, timings in ms: {timings}')
+    return [{'image': image_name, **result} for image_name, result in zip(image_names, results)]
+
+
 @celery.task
 def compute_embedding_task(image_name):
     embedding = compute_embedding(image_name)
@@ -33,42 +240,126 @@ def compute_embedding_task(image_name):
 
 
 @celery.task
-def retrieve_similar_papyrus_task(embedding):
-    urls = retrieve_similar_papyrus(embedding)
-    return urls
+def retrieve_similar_papyrus_task(embedding, k=1, min_similarity=None):
+    matches = retrieve_similar_papyrus(embedding, k, min_similarity)
+    return matches
 
 
 def compute_embedding(image_name):
-    image = download_image_from_minio(image_name)
-    response = send_image_to_litserve(image)
-    return response.get('embedding')
+    image_data = download_image_from_minio(image_name)
+    response = send_image_to_litserve(image_data)
+    embedding = response.get('embedding')
+    _cache_value('embedding', image_name, embedding)
+    return embedding
+
+
+def retrieve_similar_papyrus(embedding, k: int = 1, min_similarity: Optional[float] = None) -> Dict[str, list]:
+    """:return: dict with the matched ``urls`` and their cosine similarity ``scores``, best first."""
+    database = get_database()
+    matches = database.papyrus_embedding_repository.get_matches(embedding, k, min_similarity)
+    result = {'urls': [match.url for match in matches], 'scores': [match.similarity for match in matches]}
+    _cache_value('search', _search_key(embedding, k, min_similarity), result)
+    return result
+
 
+def retrieve_similar_papyrus_batch(
+    embeddings: List[List[float]], k: int = 1, min_similarity: Optional[float] = None
+) -> List[Dict[str, list]]:
+    """:return: one result like :func:`retrieve_similar_papyrus` per embedding, in the same order."""
+    database = get_database()
+    results = []
+    for embedding, matches in zip(
+        embeddings, database.papyrus_embedding_repository.get_matches_batch(embeddings, k, min_similarity)
+    ):
+        result = {'urls': [match.url for match in matches], 'scores': [match.similarity for match in matches]}
+        _cache_value('search', _search_key(embedding, k, min_similarity), result)
+        results.append(result)
+    return results
 
-def retrieve_similar_papyrus(embedding):
-    database = Postgres.from_config(cfg)
-    urls = database.papyrus_embedding_repository.get_k_nearest_embeddings(embedding, k=1)
-    return urls
 
+def _search_key(embedding: List[float], k: int, min_similarity: Optional[float]) -> str:
+    return f'{hashlib.sha256(json.dumps(embedding).encode()).hexdigest()}:{k}:{min_similarity}'
 
-def download_image_from_minio(image_name):
-    minio_client = MinioClient.from_config(cfg)
+
+def _cache_value(name: str, key: str, value) -> None:
+    cache = get_cache()
+    if cache and value is not None:
+        cache.set(name, key, value)
+
+
+def _completed_result(result) -> AsyncResult:
+    """Publish an already known result under a new task id, so it can be fetched like any task result."""
+    task_id = str(uuid.uuid4())
+    celery.backend.store_result(task_id, result, states.SUCCESS)
+    return AsyncResult(task_id, app=celery)
+
+
+@contextmanager
+def _timed(timings: Dict[str, float], stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = (time.perf_counter() - start) * 1000
+
+
+@celery.task
+def sync_storage_task():
+    """
+    Delete expired query images, so the query bucket does not grow with every submitted query.
+
+    Every run lists at most ``max_listed`` images and continues where the previous run stopped, the
+    cursor is kept in the result backend's Redis.
+
+    :return: Number of deleted query images.
+    """
+    settings = cfg.worker.periodic.sync_storage
     bucket_name = cfg.storage.buckets[0]
-    response = minio_client.client.get_object(bucket_name, image_name)
-    image_data = response.read()
-    image = Image.open(io.BytesIO(image_data))
-    return image
-
-
-def send_image_to_litserve(image):
-    img_byte_arr = io.BytesIO()
-    image.save(img_byte_arr, format='JPEG')
-    img_byte_arr.seek(0)
-    files = {'request': ('image.jpg', img_byte_arr, 'image/jpeg')}
-    # response = requests.post("http://127.0.0.1:8001/predict", files=files)
-    response = requests.post(cfg.inference.url + '/predict', files=files)
-    if response.status_code == 200:
-        log.info(f'Prediction result: {response.json}')
-    else:
-        log.info(f'Error: {response.text}')
+    redis = get_publisher()
+    try:
+        start_after = redis.get(SYNC_STORAGE_CURSOR)
+    except RedisError as exc:
+        log.warning(f'Failed to read the storage sync cursor, listing from the start: {exc}')
+        start_after = None
+    removed, cursor = get_minio_client().remove_expired_objects(
+        bucket_name,
+        timedelta(seconds=settings.max_age),
+        settings.limit,
+        settings.max_listed,
+        start_after.decode() if start_after else None,
+    )
+    try:
+        if cursor is None:
+            redis.delete(SYNC_STORAGE_CURSOR)
+        else:
+            redis.set(SYNC_STORAGE_CURSOR, cursor)
+    except RedisError as exc:
+        log.warning(f'Failed to store the storage sync cursor: {exc}')
+    log.info(f'Deleted {removed} expired query images from {bucket_name}')
+    return removed
+
+
+def download_image_from_minio(image_name) -> bytes:
+    """Fetch the encoded query image. It is decoded only once, by the inference server."""
+    minio_client = get_minio_client()
+    bucket_name = cfg.storage.buckets[0]
+    with timed('worker', 'minio_get'):
+        response = minio_client.client.get_object(bucket_name, image_name)
+        try:
+            image_data = response.read()
+        finally:
+            # Hand the connection back to the shared pool
+            response.close()
+            response.release_conn()
+    return image_data
+
+
+def send_image_to_litserve(image_data: bytes):
+    files = {'request': ('image.jpg', image_data, 'image/jpeg')}
+    with timed('worker', 'predict'):
+        response = requests.post(cfg.inference.url + '/predict', files=files)
+    if response.status_code != 200:
+        log.error(f'Inference request failed with status {response.status_code}: {response.text}')
+        response.raise_for_status()
 
     return response.json()
@@ -193,7 +193,7 @@ function handleSubmit(e) {
             .then(response => response.ok ? response.json() : Promise.reject('Network response was not ok'))
             .then(data => {
                 statusElement.textContent = 'Task Status: ' + data.status;
-                if (data.task_id) pollTaskStatus(data.task_id);
+                if (data.task_id) waitForTaskResult(data.task_id);
             })
             .catch(error => statusElement.textContent = 'Error: ' + error.message);
     } catch (error) {
@@ -304,6 +304,56 @@ function sortPoints(pts) {
     return pts;
 }
 
+function waitForTaskResult(task_id) {
+    // The server pushes the result as soon as the task has finished, polling is only a fallback
+    if (!window.EventSource) {
+        pollTaskStatus(task_id);
+        return;
+    }
+    const events = new EventSource(`/papyrus/result/${task_id}/events`);
+    events.addEventListener('status', event => {
+        statusElement.textContent = 'Task Status: ' + JSON.parse(event.data).query_status;
+    });
+    events.addEventListener('result', event => {
+        events.close();
+        showTaskResult(JSON.parse(event.data));
+    });
+    events.addEventListener('timeout', () => {
+        events.close();
+        pollTaskStatus(task_id);
+    });
+    events.onerror = () => {
+        // The stream was interrupted before a result arrived
+        events.close();
+        pollTaskStatus(task_id);
+    };
+}
+
+function showTaskResult(data) {
+    if (data.query_status === 'SUCCESS') {
+        statusElement.textContent = 'Task completed successfully!';
+        console.log('Result:', data.query_result);  // Use the result here
+        // Display the URLs in the resultContainer as clickable links
+        const resultContainer = document.getElementById('resultContainer');
+        const resultElement = document.getElementById('result');
+        resultElement.innerHTML = '';  // Clear previous content
+
+        // Assuming data.query_result is an array of URLs
+        data.query_result.forEach(url => {
+            const linkElement = document.createElement('a');
+            linkElement.href = url;
+            linkElement.textContent = url;
+            linkElement.target = '_blank';  // Opens in a new tab
+            linkElement.style.display = 'block';  // Each URL on a new line
+            resultElement.appendChild(linkElement);
+        });
+
+        resultContainer.style.display = 'block';
+    } else {
+        statusElement.textContent = 'Task failed.';
+    }
+}
+
 function pollTaskStatus(task_id) {
     const interval = setInterval(() => {
         fetch(`/papyrus/result/${task_id}`)  // Use backticks here for template literal
@@ -317,27 +367,10 @@ function pollTaskStatus(task_id) {
                 // Check the correct key for the status
                 if (data.query_status === 'SUCCESS') {
                     clearInterval(interval);  // Stop polling when task completes
-                    statusElement.textContent = 'Task completed successfully!';
-                    console.log('Result:', data.query_result);  // Use the result here
-                    // Display the URLs in the resultContainer as clickable links
-                    const resultContainer = document.getElementById('resultContainer');
-                    const resultElement = document.getElementById('result');
-                    resultElement.innerHTML = '';  // Clear previous content
-
-                    // Assuming data.query_result is an array of URLs
-                    data.query_result.forEach(url => {
-                        const linkElement = document.createElement('a');
-                        linkElement.href = url;
-                        linkElement.textContent = url;
-                        linkElement.target = '_blank';  // Opens in a new tab
-                        linkElement.style.display = 'block';  // Each URL on a new line
-                        resultElement.appendChild(linkElement);
-                    });
-
-                    resultContainer.style.display = 'block';
+                    showTaskResult(data);
                 } else if (data.query_status === 'FAILURE') {
                     clearInterval(interval);  // Stop polling on failure
-                    statusElement.textContent = 'Task failed.';
+                    showTaskResult(data);
                 } else {
                     // Task still in progress (PENDING, STARTED)
                     statusElement.textContent = 'Task Status: ' + data.query_status;
@@ -349,5 +382,3 @@ function pollTaskStatus(task_id) {
             });
     }, 2000);  // Poll every 2 seconds
 }
-
-
@@ -1,34 +1,85 @@
 from io import BytesIO
-import cv2
 import numpy as np
-import uuid
+import hashlib
 from fastapi import UploadFile
-from hydra import compose
+from src.config import get_config
+from src.metrics.prometheus import timed
 
-cfg = compose(config_name='config')
+# OpenCV is imported by the functions using it, so that importing this module stays cheap
 
 
 def preprocess_image(image_content: bytes, coordinates, minio_client):
-    image_bytes = np.frombuffer(image_content, np.uint8)
-    image = cv2.imdecode(image_bytes, cv2.IMREAD_COLOR)
+    image_data = warp_image(image_content, coordinates)
+    return store_image(image_data, minio_client)
+
+
+# JPEG decoders downscale by these factors during decoding, at a fraction of the cost of a full decode
+REDUCED_DECODE_FLAGS = {8: 'IMREAD_REDUCED_COLOR_8', 4: 'IMREAD_REDUCED_COLOR_4', 2: 'IMREAD_REDUCED_COLOR_2'}
+
+
+def warp_image(image_content: bytes, coordinates, max_side=None) -> bytes:
+    """
+    Decode the uploaded photo, warp the marked papyrus region and return it JPEG encoded.
 
+    The model only sees 224x224 inputs, so the warped region is capped at ``max_side`` pixels
+    (``api.preprocess.max_side`` by default). When the region is much larger than that, the photo
+    is decoded at a reduced scale that still covers ``max_side`` and the coordinates are scaled
+    to match.
+    """
+    import cv2
+
+    if max_side is None:
+        max_side = get_config().api.preprocess.max_side
     pts = np.array(coordinates, dtype='float32')
-    warped_image = perspective_transform(image, pts)
 
-    is_success, buffer = cv2.imencode('.jpg', warped_image)
+    scale = decode_scale(pts, max_side)
+    image_bytes = np.frombuffer(image_content, np.uint8)
+    with timed('api', 'decode'):
+        image = cv2.imdecode(image_bytes, getattr(cv2, REDUCED_DECODE_FLAGS.get(scale, 'IMREAD_COLOR')))
+    if image is None:
+        raise ValueError('Failed to decode image')
+
+    with timed('api', 'warp'):
+        warped_image = perspective_transform(image, pts / scale, max_side)
+
+    with timed('api', 'encode'):
+        is_success, buffer = cv2.imencode('.jpg', warped_image)
     if not is_success:
         raise ValueError('Failed to encode image')
+    return buffer.tobytes()
+
 
-    image_bytes_io = BytesIO(buffer)
-    filename = f'papyrus_{uuid.uuid4()}.jpg'
+def decode_scale(pts, max_side) -> int:
+    """Largest reduced decode factor at which the marked region still spans at least ``max_side`` pixels."""
+    if not max_side:
+        return 1
+    width, height = warped_size(order_points(pts))
+    for scale in REDUCED_DECODE_FLAGS:
+        if max(width, height) / scale >= max_side:
+            return scale
+    return 1
 
-    bucket_name = cfg.storage.buckets[0]
-    minio_client.client.put_object(bucket_name, filename, image_bytes_io, len(buffer), content_type='image/jpeg')
+
+def store_image(image_data: bytes, minio_client) -> str:
+    """
+    Store an encoded query image in the query bucket and return its object name.
+
+    The object is named by the content hash of the image, which also serves as the key of the embedding cache.
+    """
+    filename = f'papyrus_{hashlib.sha256(image_data).hexdigest()}.jpg'
+
+    bucket_name = get_config().storage.buckets[0]
+    with timed('api', 'minio_put'):
+        minio_client.client.put_object(
+            bucket_name, filename, BytesIO(image_data), len(image_data), content_type='image/jpeg'
+        )
 
     return filename
 
 
 def read_image_file(image_file: UploadFile):
+    import cv2
+
     image_bytes = np.frombuffer(image_file.file.read(), np.uint8)
     image_file.file.seek(0)  # Reset file pointer to the beginning
     image = cv2.imdecode(image_bytes, cv2.IMREAD_COLOR)
@@ -46,8 +97,7 @@ def order_points(pts):
     return rect
 
 
-def perspective_transform(image, pts):
-    rect = order_points(pts)
+def warped_size(rect):
     (tl, tr, br, bl) = rect
 
     # Compute the width of the new image
@@ -59,6 +109,19 @@ def perspective_transform(image, pts):
     heightA = np.linalg.norm(tr - br)
     heightB = np.linalg.norm(tl - bl)
     maxHeight = int(max(heightA, heightB))
+    return maxWidth, maxHeight
+
+
+def perspective_transform(image, pts, max_side=None):
+    import cv2
+
+    rect = order_points(pts)
+    maxWidth, maxHeight = warped_size(rect)
+
+    # Shrink the output to at most max_side pixels, keeping the aspect ratio
+    if max_side and max(maxWidth, maxHeight) > max_side:
+        ratio = max_side / max(maxWidth, maxHeight)
+        maxWidth, maxHeight = max(1, round(maxWidth * ratio)), max(1, round(maxHeight * ratio))
 
     # Create a destination matrix for the new image size
     dst = np.array([[0, 0], [maxWidth - 1, 0], [maxWidth - 1, maxHeight - 1], [0, maxHeight - 1]], dtype='float32')